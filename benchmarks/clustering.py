@@ -0,0 +1,79 @@
+'''
+Compare the runtime of match clustering against the previous run-block algorithm.
+
+The matches simulate two editions of the same book: a long diagonal of matching
+windows with small offsets and dropped windows, plus scattered chance matches.
+
+usage: python benchmarks/clustering.py --windows 2000
+'''
+from collections import defaultdict
+import argparse
+import random
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from intertext.intertext import config, get_match_clusters
+
+
+def get_sequences(l):
+  '''Given list of ints `l`, return [[integer sequence in l], [integer sequence in l]]'''
+  sequences = []
+  for i in sorted(set(l)):
+    if not sequences or sequences[-1][-1] != i-1:
+      sequences.append([])
+    sequences[-1].append(i)
+  return sequences
+
+
+def get_run_block_clusters(window_a, window_b, sims, **kwargs):
+  '''The previous clustering: group the matches in each (run of window_a) x (run of window_b) block'''
+  clusters = []
+  d = defaultdict(lambda: defaultdict())
+  for a, b, sim in zip(window_a, window_b, sims):
+    d[a][b] = sim
+  for a in get_sequences(window_a):
+    for b in get_sequences(window_b):
+      cluster = {'a': set(), 'b': set(), 'sim': []}
+      for a_i in a:
+        for b_i in b:
+          if d.get(a_i, {}).get(b_i):
+            cluster['a'].add(a_i)
+            cluster['b'].add(b_i)
+            cluster['sim'].append(d[a_i][b_i])
+      if cluster['a'] and cluster['b']:
+        sim = int(sum(cluster['sim']) / len(cluster['sim']))
+        if sim < kwargs['min_sim']: continue
+        clusters.append({'a': sorted(cluster['a']), 'b': sorted(cluster['b']), 'sim': sim})
+  return clusters
+
+
+def get_edition_matches(n_windows, noise, seed=0):
+  '''Return parallel lists window_a, window_b, sims for a simulated pair of editions'''
+  rand = random.Random(seed)
+  matches = {}
+  offset = 0
+  for a in range(n_windows):
+    # editions drift apart as passages are added or removed
+    if rand.random() < 0.01: offset += rand.choice([-3, -1, 1, 3])
+    if rand.random() < 0.1: continue
+    b = max(0, a + offset + rand.choice([0, 0, 0, 1, -1]))
+    matches[(a, b)] = rand.randint(50, 100)
+  for _ in range(int(n_windows * noise)):
+    matches[(rand.randrange(n_windows), rand.randrange(n_windows))] = rand.randint(50, 60)
+  window_a, window_b = zip(*matches.keys())
+  return window_a, window_b, list(matches.values())
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark intertext match clustering')
+  parser.add_argument('--windows', type=int, default=2000)
+  parser.add_argument('--noise', type=float, default=0.5, help='chance matches per window')
+  args = parser.parse_args()
+  matches = get_edition_matches(args.windows, args.noise)
+  print(' * clustering {} matches'.format(len(matches[0])))
+  for label, f in [['run blocks', get_run_block_clusters], ['adjacency', get_match_clusters]]:
+    start = time.time()
+    clusters = f(*matches, **config)
+    print(' * {:<10} {:>8.3f}s {:>8} clusters'.format(label, time.time() - start, len(clusters)))
@@ -0,0 +1,65 @@
+'''
+Measure the pairs validated per second by each --sim_engine.
+
+Candidate pairs are windows from different files that share a word 4-gram,
+which approximates the pairs that survive minhash banding.
+
+usage: python benchmarks/sim_engines.py --infiles 'sample_data/texts/*.txt'
+'''
+from collections import defaultdict
+import argparse
+import random
+import glob
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from intertext.intertext import config, get_cacheable, get_windows, get_string_sim, LEVENSHTEIN_AVAILABLE
+
+
+def get_candidate_pairs(infiles, n_pairs, **kwargs):
+  '''Return up to n_pairs [text_a, text_b] window pairs that share a word 4-gram'''
+  d = defaultdict(set)
+  windows = []
+  for file_id, path in enumerate(infiles):
+    for window in get_windows(path, **kwargs):
+      window_idx = len(windows)
+      windows.append((file_id, window))
+      words = window.split()
+      for i in range(len(words) - 3):
+        d[' '.join(words[i:i+4])].add(window_idx)
+  pairs = set()
+  for window_ids in d.values():
+    if len(window_ids) > 50: continue
+    window_ids = sorted(window_ids)
+    for i, a in enumerate(window_ids):
+      for b in window_ids[i+1:]:
+        if windows[a][0] != windows[b][0]: pairs.add((a, b))
+  pairs = sorted(pairs)
+  random.Random(0).shuffle(pairs)
+  return [[windows[a][1], windows[b][1]] for a, b in pairs[:n_pairs]]
+
+
+def benchmark(pairs, threshold, **kwargs):
+  '''Return the pairs per second and the pairs with sim >= threshold for one engine setting'''
+  start = time.time()
+  matches = sum(1 for a, b in pairs if get_string_sim(a, b, **kwargs) >= threshold)
+  return len(pairs) / (time.time() - start), matches
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark intertext similarity engines')
+  parser.add_argument('--infiles', type=str, default='sample_data/texts/*.txt')
+  parser.add_argument('--pairs', type=int, default=20000)
+  parser.add_argument('--min_sim', type=int, default=config['min_sim'])
+  args = parser.parse_args()
+  kwargs = get_cacheable(config)
+  pairs = get_candidate_pairs(sorted(glob.glob(args.infiles)), args.pairs, **kwargs)
+  print(' * benchmarking {} candidate pairs at min_sim {}'.format(len(pairs), args.min_sim))
+  engines = ['difflib', 'levenshtein'] if LEVENSHTEIN_AVAILABLE else ['difflib']
+  for engine in engines:
+    # a min_sim of 0 disables every bound, so the first row is the unpruned baseline
+    for label, bound_sim in [['no bounds', 0], ['bounds', args.min_sim]]:
+      rate, matches = benchmark(pairs, args.min_sim, **dict(kwargs, sim_engine=engine, min_sim=bound_sim))
+      print(' * {:<12} {:<10} {:>10.0f} pairs/s {:>8} matches'.format(engine, label, rate, matches))
@@ -1,27 +1,21 @@
-from networkx.algorithms.components.connected import connected_components
-from vectorizedMinHash import VectorizedMinHash,fastNGramHashes
 from collections import defaultdict, Hashable, Counter
-from datasketch import MinHash, MinHashLSH
 from difflib import SequenceMatcher
-from itertools import combinations
+from itertools import combinations, groupby, islice
 from unidecode import unidecode
-from contextlib import closing
-from bs4 import BeautifulSoup
-from bounter import bounter
+from contextlib import closing, contextmanager
+from html.parser import HTMLParser
 from copy import deepcopy
-from nltk import ngrams
 import multiprocessing
 import numpy as np
 import functools
-import distutils
-import requests
+import threading
 import argparse
-import networkx
+import hashlib
 import sqlite3
 import zipfile
-import random
 import codecs
 import shutil
+import math
 import time
 import uuid
 import glob
@@ -29,13 +23,6 @@ import json
 import os
 
 
-try:
-  import cupy
-  CUDA_AVAILABLE = True
-except:
-  CUDA_AVAILABLE = False
-
-
 try:
   from Levenshtein import ratio
   LEVENSHTEIN_AVAILABLE = True
@@ -64,6 +51,10 @@ config = {
   'hashband_step': 3,
   'banish_distance': 4,
   'min_sim': 50,
+  'min_jaccard': None,
+  'sim_engine': 'difflib',
+  'incremental': False,
+  'resume': False,
   'excluded_file_ids': tuple(),
   'banish_file_ids': tuple(),
   'max_file_sim': None,
@@ -76,6 +67,15 @@ config = {
   'verbose': False,
   'compute_probabilities': False,
   'bounter_size': 64,
+  'word_counts': 'exact',
+  'cache_dir': 'cache',
+  'cache_size': 10240,
+  'db_synchronous': 'NORMAL',
+  'commit_frequency': 10**6,
+  'memory_budget': 1024,
+  'spill_dir': None,
+  'max_bucket_size': None,
+  'stop_band_idf': None,
 }
 
 
@@ -85,23 +85,93 @@ TODO:
   * add support for CSV metadata
   * add support for xml + txt in same run
   * add MySQL db backend
-  * if resuming, process output/config.json to get the files and file ids
 '''
 
 
 # path globals
 source_location = os.path.dirname(os.path.realpath(__file__))
 client_location = os.path.join(source_location, 'client')
-cache_location = os.path.join(os.getcwd(), 'cache')
+client_manifest = '.client-manifest.json' # records the client files synced to the output directory
+formatted_dir = os.path.join('db', 'formatted') # JSON lines of the formatted matches of each file
+
+
+# validation globals
+sim_bound_tolerance = 1e-9 # slack for float rounding when comparing bounds to min_sim
+jaccard_block_size = 2**14 # candidate rows compared per vectorized minhash comparison
+tasks_per_cpu = 4 # validation and formatting work is cut into about this many tasks per cpu
+
+
+# banish globals
+window_id_bits = 32 # the low bits of each banish graph node hold its window id and the high bits its file id
+window_id_mask = 2**window_id_bits - 1
 
 
 # db globals
+max_window_id = 2**63 - 1 # exclusive upper bound that covers every window id
 row_delimiter = '\n'
 field_delimiter = '-'
+db_writer_queue = None
+db_writer_queue_size = 64 # max batches waiting for the db writer before workers block
+min_run_buffer = 2**16 # min rows buffered per run when merging hashband runs
+hashband_dtype = np.dtype([('band', np.int64), ('file_id', np.uint32), ('window_id', np.uint32)])
+insert_statements = {
+  'progress': 'INSERT INTO progress (stage, unit, count) VALUES (?,?,?);',
+  'hashbands': 'INSERT INTO hashbands (hashband, file_id, window_id) VALUES (?,?,?);',
+  'candidates': 'INSERT OR IGNORE INTO candidates (file_id_a, file_id_b, window_id_a, window_id_b) VALUES (?,?,?,?);',
+  'matches': 'INSERT INTO matches (file_id_a, file_id_b, window_id_a, window_id_b, similarity) VALUES (?,?,?,?,?);',
+}
+
+
+# cache globals
+minhash_cache_params = (
+  'encoding',
+  'xml_base_tag',
+  'xml_remove_tags',
+  'strip_diacritics',
+  'chargram_length',
+  'window_length',
+  'slide_length',
+)
+words_cache_params = (
+  'encoding',
+  'xml_base_tag',
+  'xml_remove_tags',
+  'xml_page_tag',
+  'xml_page_attr',
+  'strip_diacritics',
+)
+
+
+# incremental globals
+state_path = os.path.join('db', 'state.json')
+progress_dbs = {'hashbands': 'hashbands', 'validation': 'matches'} # sqlite dbs that store the progress of each stage with its data
+state_params = minhash_cache_params + (
+  'hashband_length',
+  'hashband_step',
+  'min_sim',
+  'min_jaccard',
+  'sim_engine',
+  'max_bucket_size',
+  'stop_band_idf',
+  'max_file_sim',
+  'exclude_glob',
+  'banish_distance',
+  'only',
+  'compute_probabilities',
+  'db',
+  'cache_dir',
+)
+
+
+# word count globals
+word_counts_dir = os.path.join('db', 'word_counts')
+sketch_depth = 4 # rows in the count-min sketch used by --word_counts approximate
+word_count_merge_size = 2**22 # max per-file word counts held before they are merged into the corpus counts
 
 
 # minhashing
-hasher = VectorizedMinHash(n_perm=256, mirror=True)
+minhash_batch_size = 2**16 # max elements in the permuted hash array of one fingerprint batch
+minhash_table_size = 2**26 # max elements in the table of permuted chargram hashes for one document
 
 
 def parse():
@@ -121,6 +191,8 @@ def parse():
   parser.add_argument('--slide_length', '-l', type=int, default=config['slide_length'], help='the length to slide windows when processing files (see README)', required=False)
   parser.add_argument('--banish_distance', '-bd', type=int, default=config['banish_distance'], help='the graph distance to travel when banishing linked matches', required=False)
   parser.add_argument('--min_sim', '-s', type=int, default=config['min_sim'], help='the minimum similarity of matches to retain)', required=False)
+  parser.add_argument('--min_jaccard', type=float, default=config['min_jaccard'], help='if specified, candidate windows whose minhash-estimated jaccard similarity is below this value (0-1) are dropped before validation', required=False)
+  parser.add_argument('--sim_engine', type=str, default=config['sim_engine'], choices=['difflib', 'levenshtein', 'auto'], help='the string similarity backend; levenshtein scores by longest common subsequence and requires python-Levenshtein, auto uses it when installed', required=False)
   parser.add_argument('--max_file_sim', '-fs', type=int, default=config['max_file_sim'], help='the maximum similarity between two files such that matches are retained', required=False)
   parser.add_argument('--output', '-o', type=str, default=config['output'], help='the output location', required=False)
   parser.add_argument('--client', '-c', type=str, default=config['client'], help='the client version to fetch and display', required=False)
@@ -131,11 +203,22 @@ def parse():
   parser.add_argument('--strip_diacritics', default=config['strip_diacritics'], help='if specified, diacritics will be parsed from texts during processing', required=False, action='store_true')
   parser.add_argument('--update_client', default=config['update_client'], help='boolean indicating whether to update the stored client', required=False, action='store_true')
   parser.add_argument('--verbose', '-v', default=config['verbose'], help='if specified, the intertext process will log more operations', required=False, action='store_true')
-  parser.add_argument('--db', default=config['db'], help='specify sqlite to use a sqlite db', required=False)
+  parser.add_argument('--db', default=config['db'], help='specify sqlite to use a sqlite db, npy to store hashbands in sorted binary runs, or any other value to use flat files', required=False)
+  parser.add_argument('--max_bucket_size', type=int, default=config['max_bucket_size'], help='hashbands shared by more than this many windows are skipped as stop-bands', required=False)
+  parser.add_argument('--stop_band_idf', type=float, default=config['stop_band_idf'], help='hashbands whose idf, log(corpus windows / windows with the hashband), is below this value are skipped as stop-bands', required=False)
+  parser.add_argument('--memory_budget', type=int, default=config['memory_budget'], help='the MB of RAM used to merge hashband runs when --db is npy', required=False)
+  parser.add_argument('--spill_dir', type=str, default=config['spill_dir'], help='the directory for intermediate hashband runs when --db is npy (defaults to db/spill)', required=False)
   parser.add_argument('--only', default=config['only'], help='only retain matches that include text from the specified file path', required=False)
+  parser.add_argument('--incremental', default=config['incremental'], help='if specified, keep the hashbands and matches from the previous run in this directory and only process files added since then', action='store_true')
+  parser.add_argument('--resume', default=config['resume'], help='if specified, continue the unfinished run in this directory from its last completed work', action='store_true')
   parser.add_argument('--update_metadata', default=config['update_metadata'], help='skip all processing and only update the metadata for a plot', action='store_true')
   parser.add_argument('--compute_probabilities', default=config['compute_probabilities'], help='compute the likelihood of strings in the corpus', action='store_true')
-  parser.add_argument('--bounter_size', default=config['bounter_size'], help='MB allocated to bounter instance', required=False)
+  parser.add_argument('--bounter_size', default=config['bounter_size'], help='MB allocated to the approximate word count sketch', required=False)
+  parser.add_argument('--word_counts', type=str, default=config['word_counts'], choices=['exact', 'approximate'], help='count words exactly or with a fixed size sketch when computing probabilities', required=False)
+  parser.add_argument('--cache_dir', type=str, default=config['cache_dir'], help='the directory in which minhashes, parsed words and dbs are cached', required=False)
+  parser.add_argument('--db_synchronous', type=str.upper, default=config['db_synchronous'], choices=['OFF', 'NORMAL', 'FULL', 'EXTRA'], help='the sqlite synchronous level used when writing (higher is more durable but slower)', required=False)
+  parser.add_argument('--commit_frequency', type=int, default=config['commit_frequency'], help='the number of rows the db writer inserts per sqlite transaction', required=False)
+  parser.add_argument('--cache_size', type=int, default=config['cache_size'], help='the max MB of cached minhashes and parsed words to retain (least recently used entries are evicted first)', required=False)
   config.update(vars(parser.parse_args()))
   if config.get('xml_remove_tags'): config['xml_remove_tags'] = tuple(config['xml_remove_tags'])
   if config['update_client']: remove_client(**config)
@@ -151,8 +234,10 @@ def remove_client(**kwargs):
 
 
 def download_client(**kwargs):
-  '''Download the client to the cache (if necessary) and copy to the output directory'''
+  '''Download the client to the cache (if necessary) and sync it to the output directory'''
   if not os.path.exists(client_location):
+    # requests is only needed to fetch the client, so it is imported here to keep startup fast
+    import requests
     print(f' * fetching client version {kwargs["client"]}')
     os.makedirs(client_location)
     zip_location = os.path.join(client_location, 'client.zip')
@@ -170,10 +255,49 @@ def download_client(**kwargs):
       if os.path.exists(former_api_location):
         shutil.rmtree(former_api_location)
   # copy the `build` directory to the output directory
-  if os.path.exists(kwargs['output']):
-    shutil.rmtree(kwargs['output'])
-  # copy the web client
-  shutil.copytree(os.path.join(client_location, 'build'), kwargs['output'])
+  sync_client(**kwargs)
+
+
+def sync_client(**kwargs):
+  '''Copy the client files that changed since the previous sync into the output directory'''
+  build_location = os.path.join(client_location, 'build')
+  manifest_path = os.path.join(kwargs['output'], client_manifest)
+  previous = {}
+  if os.path.exists(manifest_path):
+    with open(manifest_path) as f:
+      previous = json.load(f)
+  # the api data is written by process_texts when the user provides inputs, and is kept once written
+  is_api = lambda relpath: relpath.startswith('api' + os.sep)
+  user_api = os.path.exists(os.path.join(kwargs['output'], 'api')) and not any(is_api(i) for i in previous)
+  sync_api = not kwargs.get('infile_glob') and not user_api
+  manifest = {}
+  for root, dirs, files in os.walk(build_location):
+    if root == build_location and not sync_api:
+      dirs[:] = [i for i in dirs if i != 'api']
+    for i in files:
+      path = os.path.join(root, i)
+      relpath = os.path.relpath(path, build_location)
+      stat = os.stat(path)
+      manifest[relpath] = [stat.st_size, stat.st_mtime_ns]
+      out_path = os.path.join(kwargs['output'], relpath)
+      if previous.get(relpath) == manifest[relpath] and os.path.exists(out_path): continue
+      make_dir(os.path.dirname(out_path))
+      copy_client_file(path, out_path)
+  # remove the files of the previous sync that are no longer in the client
+  for relpath in set(previous) - set(manifest):
+    if (sync_api or not is_api(relpath)) and os.path.exists(os.path.join(kwargs['output'], relpath)):
+      os.remove(os.path.join(kwargs['output'], relpath))
+  with open(manifest_path + '.tmp', 'w') as out:
+    json.dump(manifest, out)
+  os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def copy_client_file(path, out_path):
+  '''Copy a client file to `out_path`, replacing any previous version atomically'''
+  # files are copied rather than hardlinked so edits to the output can never change the installed client
+  tmp_path = out_path + '.tmp'
+  shutil.copy2(path, tmp_path)
+  os.replace(tmp_path, out_path)
 
 
 def process_texts(**kwargs):
@@ -188,7 +312,7 @@ def process_texts(**kwargs):
   # update the metadata and exit if requested
   if not kwargs.get('update_metadata'):
 
-    # remove extant db and prepare output directories
+    # remove extant db (or only the data that a resumed or incremental run rebuilds)
     clear_db(**kwargs)
 
     # create the db
@@ -196,28 +320,48 @@ def process_texts(**kwargs):
     initialize_db('candidates', **kwargs)
     initialize_db('matches', **kwargs)
 
+    # mark the run as unfinished so it can be resumed but never added to
+    if not is_resuming(**kwargs): write_state(pending=True, **kwargs)
+
     # minhash files & store hashbands in db
-    print(' * creating minhashes - using CUDA:', CUDA_AVAILABLE)
-    get_all_hashbands(**kwargs)
+    print(' * creating minhashes - using CUDA:', is_cuda_available())
+    if is_stage_complete('hashbands', **kwargs):
+      kwargs['window_count'] = kwargs['state']['run']['window_count']
+    else:
+      with db_writer(**kwargs):
+        kwargs['window_count'] = get_all_hashbands(**kwargs)
+      index_hashbands(**kwargs)
+      complete_stage('hashbands', **kwargs)
 
     # find all hashbands that have multiple distict file_ids
     print(' * identifying match candidates')
-    get_all_match_candidates(**kwargs)
+    if not is_stage_complete('candidates', **kwargs):
+      with db_writer(**kwargs):
+        get_all_match_candidates(**kwargs)
+      complete_stage('candidates', **kwargs)
 
     # validate matches from among the candidates
     print(' * validating matches')
-    validate_all_matches(**kwargs)
+    if not is_stage_complete('validation', **kwargs):
+      with db_writer(**kwargs):
+        validate_all_matches(**kwargs)
+      index_matches(**kwargs)
+      complete_stage('validation', **kwargs)
 
   # banish matches if necessary
-  if kwargs['banish_glob']: banish_matches(**kwargs)
+  if kwargs['banish_glob'] and not is_stage_complete('banish', **kwargs):
+    banish_matches(**kwargs)
+    complete_stage('banish', **kwargs)
 
   # format matches into JSON for client consumption
   print(' * formatting matches')
-  format_all_matches(**kwargs)
+  if not is_stage_complete('formatting', **kwargs):
+    format_all_matches(**kwargs)
+    complete_stage('formatting', **kwargs)
 
   # combine all matches into a single match object
   print(' * formatting JSON outputs')
-  create_all_match_json(**kwargs)
+  kwargs['next_match_id'] = create_all_match_json(**kwargs)
 
   # write the output config file
   print(' * writing config')
@@ -227,6 +371,9 @@ def process_texts(**kwargs):
   print(' * preparing text reader data')
   create_reader_data(**kwargs)
 
+  # record the processed files so later runs can add to them
+  write_state(**kwargs)
+
 
 def process_kwargs(**kwargs):
   '''Return a list of the infiles to be processed'''
@@ -234,9 +381,22 @@ def process_kwargs(**kwargs):
   # check xml page kwargs
   if kwargs.get('xml_page_tag') and not kwargs.get('metadata'):
     raise Exception('--xml_page_tag requires --metadata to be provided')
+  if kwargs.get('xml_page_tag') and not kwargs.get('xml_base_tag'):
+    raise Exception('--xml_page_tag requires --xml_base_tag to be provided')
 
   # typecheck inputs
   assert kwargs['min_sim'] >= 1 and kwargs['min_sim'] <= 100
+  assert kwargs.get('max_bucket_size') is None or kwargs['max_bucket_size'] >= 2
+  assert kwargs.get('min_jaccard') is None or 0 <= kwargs['min_jaccard'] <= 1
+
+  # resolve the similarity engine
+  if kwargs['sim_engine'] == 'auto':
+    kwargs['sim_engine'] = 'levenshtein' if LEVENSHTEIN_AVAILABLE else 'difflib'
+  if kwargs['sim_engine'] == 'levenshtein' and not LEVENSHTEIN_AVAILABLE:
+    raise Exception('--sim_engine levenshtein requires python-Levenshtein to be installed')
+
+  # resolve the cache directory so all processes share the same location
+  kwargs['cache_dir'] = os.path.abspath(kwargs['cache_dir'])
 
   # get the list of infiles
   infiles = sorted(glob.glob(kwargs['infile_glob']))
@@ -247,6 +407,19 @@ def process_kwargs(**kwargs):
   if kwargs['banish_glob']:
     banished_files = sorted(glob.glob(kwargs['banish_glob']))
     infiles += banished_files
+
+  # keep the file ids of the previous run if adding files to it
+  infiles, kwargs['first_new_file_id'], kwargs['state'] = get_incremental_infiles(infiles, **kwargs)
+  # the formatted output of previous files only changes if banishing, updating metadata or recounting words
+  if is_resuming(**kwargs):
+    kwargs['first_changed_file_id'] = kwargs['state']['run']['first_changed_file_id']
+  elif kwargs['banish_glob'] or kwargs.get('update_metadata') or kwargs.get('compute_probabilities'):
+    kwargs['first_changed_file_id'] = 0
+  else:
+    kwargs['first_changed_file_id'] = kwargs['first_new_file_id']
+
+  # identify the ids of banished files
+  if kwargs['banish_glob']:
     banished_file_set = set(banished_files)
     banished_file_ids = set()
     for file_idx, file in enumerate(infiles):
@@ -274,6 +447,146 @@ def process_kwargs(**kwargs):
   return kwargs
 
 
+def get_incremental_infiles(infiles, **kwargs):
+  '''Return [infiles, first new file id, previous state] such that files from the previous run retain their ids'''
+  if not kwargs.get('incremental') and not kwargs.get('update_metadata') and not kwargs.get('resume'):
+    return [infiles, 0, None]
+  state = read_state()
+  if not state: return [infiles, 0, None]
+  registered = [i['path'] for i in state['files']]
+  infile_set = set(infiles)
+  # the file registry is dropped from the state as it can be large and kwargs are sent to every task
+  files = state.pop('files')
+  if kwargs.get('resume') and state.get('pending'):
+    if state['params'] != get_state_params(**kwargs):
+      reason = 'the params changed'
+    elif infile_set != set(registered) or any(get_file_stat(i['path']) != i['stat'] for i in files):
+      reason = 'the files changed'
+    else:
+      print(' * resuming the previous run after its', ', '.join(state['run']['stages']) or 'start')
+      return [registered, state['run']['first_new_file_id'], state]
+    print(' * unable to resume the previous run because', reason)
+  if state.get('pending'):
+    reason = 'the previous run did not finish'
+  elif state['params'] != get_state_params(**kwargs):
+    reason = 'the params changed'
+  elif any(i['path'] not in infile_set or get_file_stat(i['path']) != i['stat'] for i in files):
+    reason = 'files were changed or removed'
+  elif not os.path.isdir(formatted_dir):
+    reason = 'its formatted matches are missing'
+  else:
+    known = set(registered)
+    new_files = [i for i in infiles if i not in known]
+    # metadata updates never hash files, so new files are left for a later incremental run to process
+    if kwargs.get('update_metadata'):
+      if new_files: print(' * ignoring', len(new_files), 'new files until they are added with --incremental')
+      return [registered, len(registered), state]
+    if kwargs.get('incremental'): print(' * adding', len(new_files), 'new files to', len(registered), 'processed files')
+    return [registered + new_files, len(registered), state]
+  print(' * processing all files because', reason, 'since the previous run')
+  return [infiles, 0, None]
+
+
+def read_state():
+  '''Return the state of the previous run in this directory, if any'''
+  if not os.path.exists(state_path): return None
+  with open(state_path) as f:
+    return json.load(f)
+
+
+def write_state(pending=False, **kwargs):
+  '''Save the files, ids, and params of this run so a later run can add files to it or resume it'''
+  state = kwargs.get('state') or {}
+  # while a run is pending the state describes the previous run, which an incremental run builds on
+  hashband_rowid = state.get('hashband_rowid')
+  if kwargs.get('db') == 'sqlite' and not pending:
+    with closing(get_db('hashbands', **kwargs)) as db:
+      hashband_rowid = db.execute('SELECT COALESCE(MAX(rowid), 0) FROM hashbands;').fetchone()[0]
+  save_state({
+    'pending': pending,
+    'params': get_state_params(**kwargs),
+    'files': [{'path': i, 'stat': get_file_stat(i)} for i in kwargs['infiles']],
+    'window_count': state.get('window_count', 0) if pending else kwargs.get('window_count', state.get('window_count', 0)),
+    'hashband_rowid': hashband_rowid,
+    'next_match_id': state.get('next_match_id', 0) if pending else kwargs.get('next_match_id', state.get('next_match_id', 0)),
+    'run': {
+      'first_new_file_id': kwargs.get('first_new_file_id', 0),
+      'first_changed_file_id': kwargs.get('first_changed_file_id', 0),
+      'stages': [],
+      'window_count': None,
+    } if pending else None,
+  })
+
+
+def save_state(state):
+  '''Atomically write a state object to the state path'''
+  make_dir(os.path.dirname(state_path))
+  tmp_path = state_path + '.tmp'
+  with open(tmp_path, 'w') as out:
+    json.dump(state, out)
+  os.replace(tmp_path, state_path)
+
+
+def is_resuming(**kwargs):
+  '''Return a bool indicating whether this run continues an unfinished run'''
+  return bool((kwargs.get('state') or {}).get('run'))
+
+
+def is_stage_complete(stage, **kwargs):
+  '''Return a bool indicating whether a resumed run already completed `stage`'''
+  return is_resuming(**kwargs) and stage in kwargs['state']['run']['stages']
+
+
+def complete_stage(stage, **kwargs):
+  '''Record that the current run completed `stage`'''
+  state = read_state()
+  if not state or not state.get('run'): return
+  state['run']['stages'].append(stage)
+  if stage == 'hashbands': state['run']['window_count'] = kwargs['window_count']
+  save_state(state)
+  if kwargs.get('verbose'): print(' * completed stage', stage)
+
+
+def record_progress(stage, units, **kwargs):
+  '''Record the [unit, count] work units of a stage that are complete, committing them with the data they produced'''
+  if not units: return
+  if kwargs.get('db') == 'sqlite' and stage in progress_dbs:
+    write_rows(progress_dbs[stage], [(stage, str(unit), count) for unit, count in units], table='progress', **kwargs)
+  else:
+    path = os.path.join('db', 'progress', stage)
+    make_dir(os.path.dirname(path))
+    # append all units in a single write so concurrent workers never interleave lines
+    append_to_file(path, ''.join('{}{}{}{}'.format(unit, field_delimiter * 2, count, row_delimiter) for unit, count in units))
+
+
+def get_progress(stage, **kwargs):
+  '''Return d[unit] = count for the completed work units of a resumed stage'''
+  if not is_resuming(**kwargs): return {}
+  if kwargs.get('db') == 'sqlite' and stage in progress_dbs:
+    with closing(get_db(progress_dbs[stage], **kwargs)) as db:
+      return {unit: count for unit, count in db.execute('SELECT unit, count FROM progress WHERE stage = ?;', (stage,))}
+  path = os.path.join('db', 'progress', stage)
+  if not os.path.exists(path): return {}
+  d = {}
+  with open(path) as f:
+    for row in f.read().split(row_delimiter):
+      if not row: continue
+      unit, count = row.split(field_delimiter * 2)
+      d[unit] = int(count)
+  return d
+
+
+def get_state_params(**kwargs):
+  '''Return the params that must match for a run to add files to a previous run'''
+  return json.loads(json.dumps({k: kwargs.get(k) for k in state_params}))
+
+
+def get_file_stat(path):
+  '''Return the [size, modification time] of a file, which are assumed to change if its content does'''
+  stat = os.stat(path)
+  return [stat.st_size, stat.st_mtime_ns]
+
+
 def get_metadata(**kwargs):
   '''if the user provided metadata, store it in the kwargs'''
   metadata = json.load(open(kwargs['metadata'])) if kwargs['metadata'] else {}
@@ -290,18 +603,17 @@ def get_metadata(**kwargs):
 
 def prepare_output_directories(**kwargs):
   '''Create the folders that store output objects'''
+  # a run that processes every file replaces the api data of previous runs, which other runs keep
+  path = os.path.join(kwargs['output'], 'api')
+  if os.path.exists(path) and not (kwargs.get('update_metadata') or kwargs.get('first_new_file_id') or is_resuming(**kwargs)):
+    shutil.rmtree(path)
   for i in ['matches', 'scatterplots', 'indices', 'texts']:
     path = os.path.join(kwargs['output'], 'api', i)
     if not os.path.exists(path):
       os.makedirs(path)
 
   for i in ['minhashes']:
-    path = os.path.join(cache_location, i)
-    if not os.path.exists(path):
-      os.makedirs(path)
-
-  for i in range(len(kwargs['infiles'])):
-    path = os.path.join(kwargs['output'], 'api', 'matches', str(i))
+    path = os.path.join(kwargs['cache_dir'], i)
     if not os.path.exists(path):
       os.makedirs(path)
 
@@ -315,11 +627,24 @@ def get_only_index(**kwargs):
 
 
 def clear_db(**kwargs):
-  '''Clear the extant db'''
-  if os.path.isdir('db'):
-    shutil.rmtree('db')
-  for i in glob.glob(os.path.join('cache', '*.db')):
-    os.remove(i)
+  '''Clear the extant db, retaining the data a resumed run or a run adding files to the previous run builds on'''
+  if is_resuming(**kwargs) or kwargs.get('first_new_file_id'):
+    # candidates are only resumed by stage, so an unfinished candidates stage starts over
+    db_names = [] if is_stage_complete('candidates', **kwargs) else ['candidates']
+    # the progress of the previous run is only kept if it is being resumed
+    dirs = [os.path.join('db', i) for i in db_names + ([] if is_resuming(**kwargs) else ['progress'])]
+    for i in dirs:
+      if os.path.isdir(i):
+        shutil.rmtree(i)
+  else:
+    if os.path.isdir('db'):
+      shutil.rmtree('db')
+    db_names = ['hashbands', 'candidates', 'matches']
+  for i in db_names:
+    for suffix in ['', '-wal', '-shm']:
+      path = os.path.join(kwargs['cache_dir'], '{}.db{}'.format(i, suffix))
+      if os.path.exists(path):
+        os.remove(path)
 
 
 def write_config(**kwargs):
@@ -351,45 +676,201 @@ def write_config(**kwargs):
 
 
 def get_all_hashbands(**kwargs):
-  '''Generate and save hashbands for each infile'''
-  pool = multiprocessing.Pool()
-  l = [[idx, i] for idx, i in enumerate(kwargs['infiles'])]
+  '''Generate and save hashbands for each infile and return the total number of windows'''
+  # only hash the files that were not processed by the previous run or before this run was interrupted
+  done = {int(k): v for k, v in get_progress('hashbands', **kwargs).items()}
+  delete_unfinished_hashbands(done, **kwargs)
+  l = [[idx, i] for idx, i in enumerate(kwargs['infiles']) if idx >= kwargs.get('first_new_file_id', 0) and idx not in done]
   f = functools.partial(get_file_hashbands, **kwargs)
-  for i in pool.map(f, l): pass
-  pool.close()
-  pool.join()
+  with get_pool() as pool:
+    window_count = sum(pool.map(f, l)) + sum(done.values())
+  return window_count + ((kwargs.get('state') or {}).get('window_count') or 0)
 
 
 def get_file_hashbands(args, **kwargs):
   '''Minhash a file and save [[hashband, file_idx, window_idx]]'''
   file_idx, file_path = args
   minhashes = get_file_minhashes(file_path, **kwargs)
-  # get the hashbands for this minhash
-  hashbands = set()
-  for window_idx, minhash in enumerate(minhashes):
-    for hdx, h in enumerate(ngrams(minhash, kwargs['hashband_length'])):
-      if hdx % kwargs['hashband_step'] == 0:
-        hashbands.add(tuple(['.'.join([str(i) for i in h]), file_idx, window_idx]))
+  hashbands = get_hashbands(minhashes, file_idx, **kwargs)
   write_hashbands(hashbands, **kwargs)
+  # tokenize the file once so later stages can memory-map its windows
+  write_window_store(file_idx, file_path, **get_cacheable(kwargs))
+  record_progress('hashbands', [[file_idx, len(minhashes)]], **kwargs)
+  return len(minhashes)
+
+
+def get_hashbands(minhashes, file_idx, **kwargs):
+  '''Given a 2D minhash array for a file return a structured array of unique (band, file_id, window_id)'''
+  if minhashes.ndim != 2 or minhashes.shape[1] < kwargs['hashband_length']:
+    return np.empty(0, dtype=hashband_dtype)
+  # view each window's minhash as overlapping hashbands, then retain every hashband_step-th band
+  bands = np.lib.stride_tricks.sliding_window_view(minhashes, kwargs['hashband_length'], axis=1)
+  bands = bands[:, ::kwargs['hashband_step']]
+  n_windows, n_bands = bands.shape[:2]
+  hashbands = np.empty(n_windows * n_bands, dtype=hashband_dtype)
+  hashbands['band'] = get_band_keys(bands.reshape(-1, kwargs['hashband_length']))
+  hashbands['file_id'] = file_idx
+  hashbands['window_id'] = np.repeat(np.arange(n_windows, dtype=np.uint32), n_bands)
+  return np.unique(hashbands)
+
+
+def get_band_keys(bands):
+  '''Given a 2D uint32 array with one hashband per row, return one non-negative 63-bit key per row'''
+  keys = np.full(len(bands), 0xcbf29ce484222325, dtype=np.uint64)
+  with np.errstate(over='ignore'):
+    # fold each minhash value into the key (FNV-1a over 32-bit words), then apply a 64-bit finalizer
+    for i in range(bands.shape[1]):
+      keys ^= bands[:, i].astype(np.uint64)
+      keys *= np.uint64(0x100000001b3)
+    keys ^= keys >> np.uint64(33)
+    keys *= np.uint64(0xff51afd7ed558ccd)
+    keys ^= keys >> np.uint64(33)
+    keys *= np.uint64(0xc4ceb9fe1a85ec53)
+    keys ^= keys >> np.uint64(33)
+  # drop the high bit so keys fit in a signed sqlite INTEGER
+  return (keys >> np.uint64(1)).astype(np.int64)
 
 
 def get_file_minhashes(file_path, **kwargs):
   '''Return the minhash array for a file'''
-  minhash_path = os.path.join(cache_location, 'minhashes', file_path.replace(os.path.sep, '___') + '.npy')
+  minhash_path = get_cache_path('minhashes', get_minhash_cache_key(file_path, **kwargs) + '.npy', **kwargs)
   if os.path.exists(minhash_path):
-    print(' * loading', file_path, 'minhashes from cache')
-    return np.load(minhash_path)
+    try:
+      minhashes = np.load(minhash_path)
+      print(' * loading', file_path, 'minhashes from cache')
+      touch_cache_entry(minhash_path, **kwargs)
+      return minhashes
+    except (OSError, ValueError):
+      # the entry was evicted or partially written by another process - recompute it
+      pass
   # run minhash algorithm on file
-  l = []
-  for window_idx, window in enumerate(get_windows(file_path, **get_cacheable(kwargs))):
-    char_hashes = fastNGramHashes(window.lower().encode(kwargs['encoding']), n=kwargs['chargram_length'])
-    fingerprint = hasher.fingerprint(char_hashes, cuda=CUDA_AVAILABLE)
-    l.append(fingerprint)
-  minhashes = np.array(l)
-  np.save(minhash_path, minhashes)
+  minhashes = get_document_minhashes(file_path, **kwargs)
+  write_cache_entry(minhash_path, lambda out: np.save(out, minhashes), **kwargs)
   return minhashes
 
 
+def get_document_minhashes(file_path, **kwargs):
+  '''Return one minhash fingerprint per window of a file, hashing each distinct chargram in the file once'''
+  # window bytes are only slices of the document's bytes if the encoding is stateless
+  encoding = kwargs['encoding']
+  if 'a'.encode(encoding) * 2 != 'aa'.encode(encoding):
+    hashes, window_starts, counts = get_window_chargram_hashes(get_windows(file_path, **get_cacheable(kwargs)), **kwargs)
+  else:
+    hashes, window_starts, counts = get_document_chargram_hashes(get_words(file_path, **get_cacheable(kwargs)), **kwargs)
+  if not len(counts): return np.array([])
+  if (counts < 1).any():
+    raise Exception('Cannot fingerprint zero-length hash array')
+  return get_fingerprints(hashes, window_starts, counts)
+
+
+def get_document_chargram_hashes(words, **kwargs):
+  '''Return [hashes, window_starts, counts] where hashes holds the hash of the chargram at each byte of the document'''
+  encoding = kwargs['encoding']
+  first_words = np.arange(0, len(words) - kwargs['window_length'] + 1, kwargs['slide_length'])
+  if not len(first_words): return [np.array([], dtype=np.uint32), first_words, first_words]
+  # find the byte offset of each word in the lowercased document, in which words are joined by single spaces
+  encoded = [w.lower().encode(encoding) for w in words]
+  space = ' '.encode(encoding)
+  word_lengths = np.array([len(w) for w in encoded])
+  word_starts = np.concatenate([[0], np.cumsum(word_lengths + len(space))[:-1]])
+  # the chargrams of window i begin at byte positions [window_starts[i], window_starts[i] + counts[i])
+  last_words = first_words + kwargs['window_length'] - 1
+  window_starts = word_starts[first_words]
+  counts = word_starts[last_words] + word_lengths[last_words] - window_starts - kwargs['chargram_length'] + 1
+  return [get_chargram_hashes(space.join(encoded), kwargs['chargram_length']), window_starts, counts]
+
+
+def get_window_chargram_hashes(windows, **kwargs):
+  '''Return [hashes, window_starts, counts] where hashes concatenates the chargram hashes of each window'''
+  from vectorizedMinHash import fastNGramHashes
+  hashes = [fastNGramHashes(w.lower().encode(kwargs['encoding']), n=kwargs['chargram_length']) for w in windows]
+  counts = np.array([len(h) for h in hashes], dtype=np.int64)
+  window_starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+  return [np.concatenate(hashes) if hashes else np.array([], dtype=np.uint32), window_starts, counts]
+
+
+def get_fingerprints(hashes, window_starts, counts):
+  '''Return one fingerprint per window, where window i covers hashes[window_starts[i]:window_starts[i] + counts[i]]'''
+  # permute each distinct chargram hash only once
+  grams, inverse = np.unique(hashes, return_inverse=True)
+  hasher = get_hasher()
+  minhashes = np.empty((len(counts), hasher.n_perm * (2 if hasher.mirror else 1)), dtype=np.uint32)
+  n_perms = max(1, minhash_table_size // len(grams))
+  for perm_start in range(0, hasher.n_perm, n_perms):
+    perm_end = min(perm_start + n_perms, hasher.n_perm)
+    perms = slice(perm_start, perm_end)
+    mirrored = slice(hasher.n_perm + perm_start, hasher.n_perm + perm_end)
+    permuted = get_permuted_hashes(grams, perms).astype(np.uint32)
+    # each window's fingerprint is the min (and mirrored max) of the permuted hashes at its positions
+    for start, end in get_batches(counts, max(1, minhash_batch_size // permuted.shape[1])):
+      window_counts = counts[start:end]
+      offsets = np.concatenate([[0], np.cumsum(window_counts)[:-1]])
+      positions = np.arange(window_counts.sum()) - np.repeat(offsets - window_starts[start:end], window_counts)
+      h = permuted[inverse[positions]]
+      minhashes[start:end, perms] = np.minimum.reduceat(h, offsets, axis=0)
+      if hasher.mirror:
+        minhashes[start:end, mirrored] = np.uint32(hasher._max_hash) - np.maximum.reduceat(h, offsets, axis=0)
+  return minhashes
+
+
+def get_chargram_hashes(b, n):
+  '''Given a bytes object return the hash of the n-byte chargram that begins at each position'''
+  from vectorizedMinHash import cutBytes
+  hashes = np.empty(max(0, len(b) - n + 1), dtype=np.uint32)
+  # fastNGramHashes reads chargrams at each offset in strides of n bytes; interleave the strides
+  for offset in range(n):
+    strided = hashes[offset::n]
+    strided[:] = cutBytes(b, n, offset)[:len(strided)]
+  return hashes
+
+
+def get_permuted_hashes(hashes, perms=slice(None)):
+  '''Apply the same universal hashing as VectorizedMinHash.fingerprint to each hash (columns are permutations)'''
+  hasher = get_hasher()
+  a, b = hasher.permutations
+  xp = np
+  if is_cuda_available():
+    import cupy as xp
+  h = xp.asarray(a[perms]) * xp.asarray(hashes.astype(np.uint64))[:, np.newaxis]
+  h += xp.asarray(b[perms])
+  h %= np.uint64(hasher._mersenne_prime)
+  h &= np.uint64(hasher._max_hash)
+  return h if xp is np else h.get()
+
+
+def get_batches(lengths, size):
+  '''Given an array of item lengths, return [start, end) index pairs of consecutive items whose lengths sum to ~size'''
+  ends = np.cumsum(lengths)
+  breaks = np.searchsorted(ends, np.arange(size, ends[-1], size), side='right')
+  breaks = np.unique(np.append(breaks[breaks > 0], len(lengths)))
+  return list(zip(np.concatenate([[0], breaks[:-1]]).tolist(), breaks.tolist()))
+
+
+@functools.lru_cache(maxsize=1)
+def get_hasher():
+  '''Return the minhasher, importing vectorizedMinHash (which imports cupy if installed) on first use'''
+  from vectorizedMinHash import VectorizedMinHash
+  return VectorizedMinHash(n_perm=256, mirror=True)
+
+
+@functools.lru_cache(maxsize=1)
+def is_cuda_available():
+  '''Return a bool indicating whether cupy can be imported, importing it on first use'''
+  try:
+    import cupy
+    return True
+  except:
+    return False
+
+
+def get_minhash_cache_key(file_path, **kwargs):
+  '''Return the cache key for the minhashes of a file processed with the current params'''
+  params = {k: kwargs.get(k) for k in minhash_cache_params}
+  hasher = get_hasher()
+  params['hasher'] = [hasher.n_perm, hasher.seed, hasher.mirror]
+  return get_cache_key(file_path, params)
+
+
 ##
 # Get match candidates
 ##
@@ -397,68 +878,75 @@ def get_file_minhashes(file_path, **kwargs):
 
 def get_all_match_candidates(**kwargs):
   '''Find all hashbands that have multiple distinct file_ids and save as match candidates'''
-  rows = []
-  for row in stream_hashbands(**kwargs):
-    rows.append(row)
-    # the hashbands table is our largest data artifact - paginate in blocks
-    if len(rows) >= kwargs['batch_size']:
-      process_candidate_hashbands(rows, **kwargs)
-      rows = []
-  process_candidate_hashbands(rows, **kwargs)
-
-
-def process_candidate_hashbands(l, **kwargs):
-  '''Given a set of hashbands, subdivide into processes to find match candidates for each'''
-  if kwargs['verbose']: print(' * processing match candidate block')
-  pool = multiprocessing.Pool()
-  l = list(subdivide(l, len(l) // multiprocessing.cpu_count()))
   f = functools.partial(get_hashband_match_candidates, **kwargs)
-  writes = set()
-  for idx, i in enumerate(pool.map(f, l)):
-    writes.update(i)
-    if len(writes) >= kwargs['write_frequency'] or idx == len(l)-1:
-      write_candidates(writes, **kwargs)
-      writes = set()
-  if writes: write_candidates(writes, **kwargs)
-  pool.close()
-  pool.join()
+  with get_pool() as pool:
+    for i in imap_bounded(pool, f, stream_hashband_tasks(**kwargs)):
+      if kwargs['verbose']: print(' * processed match candidate block')
+
+
+def stream_hashband_tasks(**kwargs):
+  '''Stream lists of (hashband, [(file_id, window_id)]) groups with about batch_size rows per list'''
+  # the hashbands arrive sorted by hashband, so each group is complete and lands in exactly one task
+  task = []
+  size = 0
+  stop_bands = 0
+  skipped_pairs = 0
+  for hashband, rows in groupby(stream_hashbands(**kwargs), key=lambda row: row[0]):
+    rows = [(row[1], row[2]) for row in rows]
+    # the group size is the exact frequency of the hashband, so stop-bands are dropped before any pairs exist
+    if is_stop_band(len(rows), **kwargs):
+      stop_bands += 1
+      skipped_pairs += count_cross_file_pairs(rows)
+      continue
+    task.append((hashband, rows))
+    size += len(rows)
+    if size >= kwargs['batch_size']:
+      yield task
+      task = []
+      size = 0
+  if task: yield task
+  if kwargs.get('max_bucket_size') or kwargs.get('stop_band_idf') is not None:
+    print(' * skipped', skipped_pairs, 'candidate pairs from', stop_bands, 'stop-bands')
+
+
+def is_stop_band(size, **kwargs):
+  '''Return a bool indicating whether a hashband shared by `size` windows is too common to generate candidates'''
+  if kwargs.get('max_bucket_size') and size > kwargs['max_bucket_size']:
+    return True
+  if kwargs.get('stop_band_idf') is not None and kwargs.get('window_count'):
+    return math.log(kwargs['window_count'] / size) < kwargs['stop_band_idf']
+  return False
 
 
-def get_hashband_match_candidates(args, **kwargs):
-  '''Given a hashband, save the file_id, window_id values that contain the hashband'''
-  results = []
-  last_hashband = args[0][0]
-  hashband_values = set()
-  for idx, i in enumerate(args):
-    hashband, file_id, window_id = i
-    tup = tuple([file_id, window_id])
-    if hashband == last_hashband:
-      hashband_values.add(tup)
-    elif (hashband != last_hashband) or (idx == len(args)-1):
-      last_hashband = hashband
-      if kwargs.get('only_index') != None:
-        if not any([i[0] == kwargs['only_index'] for i in hashband_values]):
-          continue
-      for a, b in combinations(hashband_values, 2):
-        if kwargs.get('only_index') != None:
-          if a[0] != kwargs['only_index'] and b[0] != kwargs['only_index']:
-            continue
-        # skip same file matches
-        if a[0] == b[0]:
-          continue
-        elif a[0] < b[0]:
-          results.append(tuple([a[0], b[0], a[1], b[1]]))
-        else:
-          results.append(tuple([b[0], a[0], b[1], a[1]]))
-      hashband_values = set([tup])
-  return set(results)
+def count_cross_file_pairs(rows):
+  '''Given [(file_id, window_id)] return the number of pairs of rows from different files'''
+  counts = Counter(file_id for file_id, window_id in rows).values()
+  return (len(rows)**2 - sum(i**2 for i in counts)) // 2
 
 
-def subdivide(l, n):
-  '''Subdivide list `l` into units `n` long'''
-  if not l or not n: return l
-  for i in range(0, len(l), n):
-    yield l[i:i + n]
+def get_hashband_match_candidates(groups, **kwargs):
+  '''Given [(hashband, [(file_id, window_id)])] groups, save the window pairs from distinct files that share a hashband'''
+  results = set()
+  for hashband, hashband_values in groups:
+    hashband_values = set(hashband_values)
+    if kwargs.get('only_index') != None:
+      if not any([i[0] == kwargs['only_index'] for i in hashband_values]):
+        continue
+    for a, b in combinations(hashband_values, 2):
+      if kwargs.get('only_index') != None:
+        if a[0] != kwargs['only_index'] and b[0] != kwargs['only_index']:
+          continue
+      # skip same file matches and pairs of files processed by the previous run
+      if a[0] == b[0] or max(a[0], b[0]) < kwargs.get('first_new_file_id', 0):
+        continue
+      elif a[0] < b[0]:
+        results.add(tuple([a[0], b[0], a[1], b[1]]))
+      else:
+        results.add(tuple([b[0], a[0], b[1], a[1]]))
+      if len(results) >= kwargs['write_frequency']:
+        write_candidates(results, **kwargs)
+        results = set()
+  write_candidates(results, **kwargs)
 
 
 ##
@@ -468,30 +956,35 @@ def subdivide(l, n):
 
 def validate_all_matches(**kwargs):
   '''Run match validations and yield [a_file,b_file,a_window,b_window]'''
-  pool = multiprocessing.Pool()
-  l = stream_candidate_file_id_pairs(**kwargs)
-  f = functools.partial(validate_file_matches, **kwargs)
-  for i in pool.map(f, l): pass
-  pool.close()
-  pool.join()
+  tasks = get_tasks(stream_candidate_pair_counts(**kwargs), split=True, **kwargs)
+  # skip the window ranges validated before this run was interrupted
+  done = get_progress_ranges(get_progress('validation', **kwargs))
+  delete_unfinished_matches(done, **kwargs)
+  tasks = remove_completed_ranges(tasks, done)
+  f = functools.partial(run_task, 'validation', functools.partial(validate_file_matches, **kwargs), **kwargs)
+  with get_pool() as pool:
+    for task, elapsed in imap_bounded(pool, f, tasks):
+      if kwargs['verbose']: report_task('validated', task, elapsed)
 
 
 def validate_file_matches(file_args, **kwargs):
-  '''Validate the matches for a single file pair and return [a_file,b_file,a_window,b_window]'''
-  file_id_a, file_id_b = file_args
+  '''Validate the matches for a file pair, optionally limited to a [start, end) range of window_id_a'''
+  file_id_a, file_id_b = file_args[:2]
+  window_range = file_args[2:] or None
+  store_a = get_window_store(file_id_a, kwargs['infiles'][file_id_a], **get_cacheable(kwargs))
+  store_b = get_window_store(file_id_b, kwargs['infiles'][file_id_b], **get_cacheable(kwargs))
+  window_count_a = get_store_window_count(store_a, **kwargs)
+  window_count_b = get_store_window_count(store_b, **kwargs)
   matches = []
-  for i in stream_matching_candidate_windows(file_id_a, file_id_b, **kwargs):
+  for i in stream_jaccard_candidate_windows(file_id_a, file_id_b, window_range, **kwargs):
     file_id_a, file_id_b, window_id_a, window_id_b = i
-    file_a_windows = list(get_windows(kwargs['infiles'][file_id_a], **get_cacheable(kwargs)))
-    file_b_windows = list(get_windows(kwargs['infiles'][file_id_b], **get_cacheable(kwargs)))
-    try:
-      text_a = file_a_windows[window_id_a]
-      text_b = file_b_windows[window_id_b]
-    except:
+    if window_id_a >= window_count_a or window_id_b >= window_count_b:
       print(' * window lookup OOB')
-      print(file_id_a, window_id_a, len(file_a_windows), kwargs['infiles'][file_id_a])
-      print(file_id_b, window_id_b, len(file_b_windows), kwargs['infiles'][file_id_b])
+      print(file_id_a, window_id_a, window_count_a, kwargs['infiles'][file_id_a])
+      print(file_id_b, window_id_b, window_count_b, kwargs['infiles'][file_id_b])
       continue
+    text_a = get_store_window(store_a, window_id_a, **kwargs)
+    text_b = get_store_window(store_b, window_id_b, **kwargs)
     sim = get_string_sim(text_a, text_b, **kwargs)
     if sim >= kwargs['min_sim']:
       # remove matches with predominance of single character words
@@ -510,6 +1003,42 @@ def validate_file_matches(file_args, **kwargs):
   write_matches(matches, **kwargs)
 
 
+def stream_jaccard_candidate_windows(file_id_a, file_id_b, window_range=None, **kwargs):
+  '''Stream candidate windows for a file pair, dropping those with estimated jaccard below min_jaccard'''
+  rows = stream_matching_candidate_windows(file_id_a, file_id_b, window_range, **kwargs)
+  if not kwargs.get('min_jaccard'):
+    yield from rows
+    return
+  signatures_a = get_file_signatures(kwargs['infiles'][file_id_a], **get_cacheable(kwargs))
+  signatures_b = get_file_signatures(kwargs['infiles'][file_id_b], **get_cacheable(kwargs))
+  dropped = 0
+  while True:
+    block = np.array(list(islice(rows, jaccard_block_size)), dtype=np.int64).reshape(-1, 4)
+    if not len(block): break
+    window_a, window_b = block[:,2], block[:,3]
+    # keep out of bounds rows so validation can report them
+    in_bounds = (window_a < len(signatures_a)) & (window_b < len(signatures_b))
+    keep = ~in_bounds
+    # the share of equal minhash values estimates the jaccard similarity of two windows' chargram sets
+    equal = signatures_a[window_a[in_bounds]] == signatures_b[window_b[in_bounds]]
+    keep[in_bounds] = equal.mean(axis=1) >= kwargs['min_jaccard']
+    dropped += len(block) - keep.sum()
+    yield from block[keep].tolist()
+  if kwargs.get('verbose'): print(' * dropped', dropped, 'candidates below min_jaccard for file pair', file_id_a, file_id_b)
+
+
+@functools.lru_cache(maxsize=128)
+def get_file_signatures(file_path, **kwargs):
+  '''Return the 2D minhash array for a file, memory-mapped from the cache when possible'''
+  minhash_path = get_cache_path('minhashes', get_minhash_cache_key(file_path, **kwargs) + '.npy', **kwargs)
+  try:
+    minhashes = np.load(minhash_path, mmap_mode='r')
+  except (OSError, ValueError):
+    # the entry was evicted since the file was hashed - recompute it
+    minhashes = get_file_minhashes(file_path, **kwargs)
+  return minhashes if minhashes.ndim == 2 else minhashes.reshape(0, 0)
+
+
 ##
 # Format matches
 ##
@@ -517,65 +1046,69 @@ def validate_file_matches(file_args, **kwargs):
 
 def format_all_matches( **kwargs):
   '''Format the match objects for each infile and store as JSON'''
-  pool = multiprocessing.Pool()
-  l = stream_matching_file_id_pairs(**kwargs)
+  # the formatted matches of the previous run are kept when only the files added since then are formatted
+  if not kwargs.get('first_changed_file_id') and not is_resuming(**kwargs) and os.path.isdir(formatted_dir):
+    shutil.rmtree(formatted_dir)
+  make_dir(formatted_dir)
+  # drop any match an interrupted run was writing when it stopped
+  if is_resuming(**kwargs):
+    for i in glob.glob(os.path.join(formatted_dir, '*.jsonl')):
+      truncate_partial_line(i)
+  # clustering needs every match of a file pair, so pairs are batched but never split
+  pairs, _ = get_formatting_pairs(**kwargs)
+  first_match_ids = {(file_id_a, file_id_b): first_match_id for file_id_a, file_id_b, _, first_match_id in pairs}
+  tasks = get_tasks([i[:3] for i in pairs], split=False, **kwargs)
+  tasks = [[(file_id_a, file_id_b, first_match_ids[(file_id_a, file_id_b)]) for file_id_a, file_id_b in task] for task in tasks]
+  # skip the file pairs formatted before this run was interrupted
+  done = get_progress('formatting', **kwargs)
+  tasks = [i for i in [[j for j in task if get_progress_unit(j) not in done] for task in tasks] if i]
   # obtain global counts of terms across corpus
-  counts = get_word_counts(**kwargs)
-  f = functools.partial(format_file_matches, counts, **kwargs)
-  for i in pool.map(f, l): pass
-  pool.close()
-  pool.join()
+  write_word_counts(**kwargs)
+  f = functools.partial(run_task, 'formatting', functools.partial(format_file_matches, **kwargs), **kwargs)
+  with get_pool() as pool:
+    for task, elapsed in imap_bounded(pool, f, tasks):
+      if kwargs['verbose']: report_task('formatted', task, elapsed)
+
+
+def get_formatting_pairs(**kwargs):
+  '''Return [[[file_id_a, file_id_b, count, first_match_id]], next_match_id] for the file pairs to be formatted'''
+  # each pair has at most one match per matching window, so reserving that many ids makes every match id deterministic
+  next_match_id = kwargs['state']['next_match_id'] if kwargs.get('first_changed_file_id') else 0
+  pairs = []
+  for file_id_a, file_id_b, count in sorted(tuple(i) for i in stream_match_pair_counts(**kwargs)):
+    pairs.append([file_id_a, file_id_b, count, next_match_id])
+    next_match_id += count
+  return [pairs, next_match_id]
 
 
-def format_file_matches(counts, file_args, **kwargs):
+def format_file_matches(file_args, **kwargs):
   ''''Format the matches for a single file pair'''
-  file_id_a, file_id_b = file_args
+  file_id_a, file_id_b, first_match_id = file_args
   if kwargs.get('excluded_file_ids'):
     if file_id_a in kwargs['excluded_file_ids'] or file_id_b in kwargs['excluded_file_ids']:
       return
   l = list(stream_file_pair_matches(file_id_a, file_id_b, **kwargs))
   if not l: return
   # check to see if this file pair has >= max allowed similarity
-  a_windows = get_windows(kwargs['infiles'][file_id_a], **get_cacheable(kwargs))
-  b_windows = get_windows(kwargs['infiles'][file_id_b], **get_cacheable(kwargs))
   if kwargs['max_file_sim']:
-    if (len(l) > len(a_windows) * kwargs['max_file_sim']) or \
-       (len(l) > len(b_windows) * kwargs['max_file_sim']):
-      print(' * file pair', *args, 'has >= max_file_sim; skipping!')
+    a_windows = get_store_window_count(get_window_store(file_id_a, kwargs['infiles'][file_id_a], **get_cacheable(kwargs)), **kwargs)
+    b_windows = get_store_window_count(get_window_store(file_id_b, kwargs['infiles'][file_id_b], **get_cacheable(kwargs)), **kwargs)
+    if (len(l) > a_windows * kwargs['max_file_sim']) or \
+       (len(l) > b_windows * kwargs['max_file_sim']):
+      print(' * file pair', file_id_a, file_id_b, 'has >= max_file_sim; skipping!')
       return []
   # cluster the matches so sequential matching windows are grouped into a single match
-  clusters = []
   _, _, window_a, window_b, sims = zip(*l)
-  d = defaultdict(lambda: defaultdict())
-  for a, b, sim in zip(window_a, window_b, sims):
-    d[a][b] = sim
-  for a in get_sequences(window_a):
-    for b in get_sequences(window_b):
-      cluster = {'a': set(), 'b': set(), 'sim': []}
-      for a_i in a:
-        for b_i in b:
-          if d.get(a_i, {}).get(b_i):
-            cluster['a'].add(a_i)
-            cluster['b'].add(b_i)
-            cluster['sim'].append(d[a_i][b_i])
-      if cluster['a'] and cluster['b']:
-        sim = int(sum(cluster['sim']) / len(cluster['sim']))
-        if sim < kwargs['min_sim']: continue
-        clusters.append({
-          'a': sorted(cluster['a']),
-          'b': sorted(cluster['b']),
-          'sim': sim,
-        })
-  # format the matches, then save into both file_id_a and file_id_b directories
-  formatted = format_matches(file_id_a, file_id_b, clusters, counts, **kwargs)
+  clusters = get_match_clusters(window_a, window_b, sims, **kwargs)
+  # format the matches, then append them to the JSON lines of both file_id_a and file_id_b
+  formatted = format_matches(file_id_a, file_id_b, clusters, first_match_id, **kwargs)
+  s = ''.join(json.dumps(i) + row_delimiter for i in formatted)
   for i in [file_id_a, file_id_b]:
-    out_dir = os.path.join(kwargs['output'], 'api', 'matches', str(i))
-    with open(os.path.join(out_dir, f'{file_id_a}-{file_id_b}.json'), 'w') as out:
-      json.dump(formatted, out)
+    append_to_file(os.path.join(formatted_dir, '{}.jsonl'.format(i)), s)
 
 
-def format_matches(file_id_a, file_id_b, clusters, counts, **kwargs):
-  '''Given integer file ids and clusters [{a: [], b: [], sim: []}] format matches for display'''
+def format_matches(file_id_a, file_id_b, clusters, first_match_id, **kwargs):
+  '''Given integer file ids, clusters [{a: [], b: [], sim: []}] and the id of the first match format matches for display'''
   file_id_a, file_id_b, clusters = order_match_pair(file_id_a, file_id_b, clusters, **kwargs)
   path_a = kwargs['infiles'][file_id_a]
   path_b = kwargs['infiles'][file_id_b]
@@ -584,8 +1117,8 @@ def format_matches(file_id_a, file_id_b, clusters, counts, **kwargs):
   a_meta = kwargs.get('metadata', {}).get(bn_a, {})
   b_meta = kwargs.get('metadata', {}).get(bn_b, {})
   # format the matches
-  a_words = get_words(path_a, **get_cacheable(kwargs, {'display': True}))
-  b_words = get_words(path_b, **get_cacheable(kwargs, {'display': True}))
+  a_words = get_window_store(file_id_a, path_a, display=True, **get_cacheable(kwargs))
+  b_words = get_window_store(file_id_b, path_b, display=True, **get_cacheable(kwargs))
   formatted = []
   # fetch a mapping from window id to $PAGE elements if necessary
   a_windows_to_page = None
@@ -596,13 +1129,13 @@ def format_matches(file_id_a, file_id_b, clusters, counts, **kwargs):
   except:
     print(' * unable to retrieve mapping from window to page id')
   # each member c in clusters is a dictionary {a: b: } where values contain the match windows
-  for c in clusters:
+  for match_idx, c in enumerate(clusters):
     a_strings = get_match_strings(a_words, c['a'], **get_cacheable(kwargs))
     b_strings = get_match_strings(b_words, c['b'], **get_cacheable(kwargs))
     formatted.append({
-      '_id': str(uuid.uuid4()),
+      '_id': first_match_id + match_idx,
       'similarity': c['sim'],
-      'probability': get_string_prob(a_strings['match'], b_strings['match'], counts),
+      'probability': get_string_prob(a_strings['match'], b_strings['match'], **kwargs),
       'source_file_id': int(file_id_a),
       'target_file_id': int(file_id_b),
       'source_segment_ids': c['a'],
@@ -657,25 +1190,56 @@ def order_match_pair(file_id_a, file_id_b, clusters, **kwargs):
 
 
 def get_match_strings(words, window_ids, **kwargs):
-  '''Given a list of words and window ids, format prematch, match, and postmatch strings for a match'''
+  '''Given a window store of display words and window ids, format prematch, match, and postmatch strings for a match'''
   start = min(window_ids) * kwargs['slide_length']
   end = max(window_ids) * kwargs['slide_length'] + kwargs['window_length']
   return {
-    'prematch': ' '.join(words[max(0, start-kwargs['window_length']):start]).lstrip('<br/>'),
-    'match': ' '.join(words[start:end]),
-    'postmatch': ' '.join(words[end:end + kwargs['window_length']]).rstrip('<br/>'),
+    'prematch': ' '.join(get_store_words(words, max(0, start-kwargs['window_length']), start)).lstrip('<br/>'),
+    'match': ' '.join(get_store_words(words, start, end)),
+    'postmatch': ' '.join(get_store_words(words, end, end + kwargs['window_length'])).rstrip('<br/>'),
   }
 
 
-def get_sequences(l):
-  '''Given list of ints `l`, return [[integer sequence in l], [integer sequence in l]]'''
-  sequences = []
-  for i in sorted( list( set(l) ) ):
-    # check if each is 1 more than the last, as segment ids increment by 1
-    if not sequences or sequences[-1][-1] != i-1:
-      sequences.append([])
-    sequences[-1].append(i)
-  return sequences
+def get_match_clusters(window_a, window_b, sims, **kwargs):
+  '''Given parallel sequences of matching window ids and sims, return [{a: [], b: [], sim: int}] for each group of adjacent matches'''
+  a = np.array(window_a, dtype=np.int64)
+  b = np.array(window_b, dtype=np.int64)
+  sims = np.array(sims, dtype=np.int64)
+  # matches are adjacent if their window ids differ by at most one in each file, so unrelated runs never merge
+  radius = 1
+  # give each (a, b) cell a key such that b - radius and b + radius never wrap into a neighbouring row
+  width = int(b.max()) + 2 * radius + 1
+  keys = a * width + b + radius
+  # sort the matches by cell, keeping the last sim seen for any repeated cell
+  keys, idx = np.unique(keys[::-1], return_index=True)
+  idx = len(a) - 1 - idx
+  a, b, sims = a[idx], b[idx], sims[idx]
+  # join each match to the adjacent matches in its row and in the following rows
+  parent = list(range(len(keys)))
+  def find(i):
+    while parent[i] != i:
+      parent[i] = parent[parent[i]]
+      i = parent[i]
+    return i
+  offsets = [row * width + col for row in range(radius + 1) for col in range(-radius, radius + 1) if row or col > 0]
+  for offset in offsets:
+    neighbours = np.minimum(np.searchsorted(keys, keys + offset), len(keys) - 1)
+    for i in np.nonzero(keys[neighbours] == keys + offset)[0].tolist():
+      parent[find(i)] = find(int(neighbours[i]))
+  # group matches by root, ordering clusters by their first cell
+  groups = defaultdict(list)
+  for i in range(len(keys)):
+    groups[find(i)].append(i)
+  clusters = []
+  for members in groups.values():
+    sim = int(sims[members].sum() / len(members))
+    if sim < kwargs['min_sim']: continue
+    clusters.append({
+      'a': np.unique(a[members]).tolist(),
+      'b': np.unique(b[members]).tolist(),
+      'sim': sim,
+    })
+  return clusters
 
 
 ##
@@ -684,40 +1248,16 @@ def get_sequences(l):
 
 
 def create_all_match_json(**kwargs):
-  '''Create the output JSON to be consumed by the web client'''
-  # combine all the matches in each match directory into a composite match file
-  guid_to_int = defaultdict(lambda: len(guid_to_int))
-  for match_directory in glob.glob(os.path.join(kwargs['output'], 'api', 'matches', '*')):
-    # l contains the flat list of matches for a single input file
-    l = []
-    for j in glob.glob(os.path.join(match_directory, '*')):
-      with open(j) as f:
-        l += json.load(f)
-    for i in l:
-      i['_id'] = guid_to_int[i['_id']]
-    with open(os.path.join(match_directory + '.json'), 'w') as out:
-      json.dump(l, out)
-    shutil.rmtree(match_directory)
-
-  # create minimal representations of all matches to be sorted by each sort heuristic below
-  l = set()
-  for file_id, matches in stream_match_lists(**kwargs):
-    for match_idx, match in enumerate(matches):
-      if int(file_id) != int(match.get('source_file_id')): continue
-      l.add(tuple([
-        match_idx,
-        match.get('source_file_id'),
-        match.get('target_file_id'),
-        min([
-          len(match.get('source_segment_ids')),
-          len(match.get('target_segment_ids')),
-        ]),
-        match.get('probability'),
-        match.get('similarity', ''),
-        match.get('source_author' ''),
-        match.get('source_title', ''),
-        match.get('source_year', ''),
-      ]))
+  '''Create the output JSON to be consumed by the web client and return the next unused match id'''
+  # combine the formatted matches of each file that may have gained matches into a composite match file
+  pairs, next_match_id = get_formatting_pairs(**kwargs)
+  file_ids = set(range(kwargs.get('first_changed_file_id', 0), len(kwargs['infiles'])))
+  file_ids.update(j for i in pairs for j in i[:2])
+  for file_id in sorted(file_ids):
+    write_match_list(file_id, **kwargs)
+
+  # read each match list once to gather the sort index rows and the scatterplot aggregates
+  l, levels = aggregate_match_lists(**kwargs)
 
   # create and store the file_id.match_index indices for each sort heuristic
   l = list(l)
@@ -739,48 +1279,118 @@ def create_all_match_json(**kwargs):
       json.dump(ids, out)
 
   # create the scatterplot data
-  write_scatterplots(**kwargs)
+  write_scatterplots(levels, **kwargs)
+  return next_match_id
+
+
+def write_match_list(file_id, **kwargs):
+  '''Stream the formatted matches of a file into its match list, ordered by match id and without duplicates'''
+  path = os.path.join(formatted_dir, '{}.jsonl'.format(file_id))
+  out_path = os.path.join(kwargs['output'], 'api', 'matches', '{}.json'.format(file_id))
+  # write to a temp file first so an interrupted run never leaves a partial match list
+  with open(out_path + '.tmp', 'wb') as out:
+    out.write(b'[')
+    if os.path.exists(path):
+      with open(path, 'rb') as f:
+        # sort the [match id, offset, length] of each line so lines can be ordered without holding the matches
+        lines = []
+        offset = 0
+        for line in f:
+          lines.append((get_line_match_id(line), offset, len(line)))
+          offset += len(line)
+        lines.sort()
+        last_id = None
+        for match_id, offset, length in lines:
+          # a resumed run may format a pair again after some of its matches were written
+          if match_id == last_id: continue
+          f.seek(offset)
+          out.write((b', ' if last_id is not None else b'') + f.read(length).rstrip(row_delimiter.encode('utf8')))
+          last_id = match_id
+    out.write(b']')
+  os.replace(out_path + '.tmp', out_path)
+
+
+def get_line_match_id(line):
+  '''Return the match id of a line of formatted matches, which begins with the _id field'''
+  return int(line[len(b'{"_id": '):line.index(b',')])
+
+
+def aggregate_match_lists(**kwargs):
+  '''Stream the match lists once and return [set of sort index rows, d[(type, unit)][level] = scatterplot aggregate]'''
+  l = set()
+  levels = {(i, j): {} for i in ['source', 'target'] for j in ['segment_ids', 'file_id', 'author']}
+  for file_id, matches in stream_match_lists(**kwargs):
+    for match_idx, match in enumerate(matches):
+      # create minimal representations of all matches to be sorted by each sort heuristic
+      if int(file_id) == int(match.get('source_file_id')):
+        l.add(tuple([
+          match_idx,
+          match.get('source_file_id'),
+          match.get('target_file_id'),
+          min([
+            len(match.get('source_segment_ids')),
+            len(match.get('target_segment_ids')),
+          ]),
+          match.get('probability'),
+          match.get('similarity', ''),
+          match.get('source_author', ''),
+          match.get('source_title', ''),
+          match.get('source_year', ''),
+        ]))
+      # keep the running similarity sum and count and the display fields of the first match for each level
+      for (i, j), d in levels.items():
+        level = get_scatterplot_level(match, i, j)
+        if level not in d:
+          d[level] = {
+            'sum': 0,
+            'count': 0,
+            'title': match[i + '_title'],
+            'author': match[i + '_author'],
+            'match': match[i + '_match'],
+            'source_year': match['source_year'],
+            'target_year': match['target_year'],
+          }
+        d[level]['sum'] += match['similarity']
+        d[level]['count'] += 1
+  return [l, levels]
+
+
+def get_scatterplot_level(match, i, j):
+  '''Return the string key that groups `match` in the scatterplot of type `i` and unit `j`'''
+  if j == 'segment_ids':
+    level = i + '.' + str(match[i + '_file_id']) + '.'
+    level += '.'.join( [str(m) for m in match[i + '_segment_ids']] )
+  else:
+    level = match[i + '_' + j]
+  # ensure the level (aka data key) is a string
+  if isinstance(level, list):
+    level = '.'.join([str(m) for m in level])
+  return level
 
 
-def write_scatterplots(**kwargs):
-  '''Write the scatterplot JSON'''
+def write_scatterplots(levels, **kwargs):
+  '''Write the scatterplot JSON given d[(type, unit)][level] = scatterplot aggregate'''
   out_dir = os.path.join(kwargs['output'], 'api', 'scatterplots')
-  for i in ['source', 'target']:
-    for j in ['segment_ids', 'file_id', 'author']:
-      for k in ['sum', 'mean']:
-        data_nest = defaultdict(list)
-        for file_id, matches in stream_match_lists(**kwargs):
-          for match in matches:
-            if j == 'segment_ids':
-              level = i + '.' + str(match[i + '_file_id']) + '.'
-              level += '.'.join( [str(m) for m in match[i + '_segment_ids']] )
-            else:
-              level = match[i + '_' + j]
-            # ensure the level (aka data key) is a string
-            if isinstance(level, list):
-              level = '.'.join([str(i) for i in level])
-            data_nest[level].append(match)
-        # format the scatterplot data
-        scatterplot_data = []
-        for level in data_nest:
-          sims = [o['similarity'] for o in data_nest[level]]
-          sim = sum(sims) if k == 'sum' else sum(sims) / len(sims)
-          o = data_nest[level][0]
-          scatterplot_data.append({
-            'type': i,
-            'unit': j,
-            'statistic': k,
-            'key': level,
-            'similarity': sim,
-            'title': o[i + '_title'],
-            'author': o[i + '_author'],
-            'match': o[i + '_match'],
-            'source_year': o['source_year'],
-            'target_year': o['target_year'],
-          })
-        # write the scatterplot data
-        with open(os.path.join(out_dir, '{}-{}-{}.json'.format(i, j, k)), 'w') as out:
-          json.dump(scatterplot_data, out)
+  for (i, j), d in levels.items():
+    for k in ['sum', 'mean']:
+      # format the scatterplot data
+      scatterplot_data = []
+      for level, o in d.items():
+        scatterplot_data.append({
+          'type': i,
+          'unit': j,
+          'statistic': k,
+          'key': level,
+          'similarity': o['sum'] if k == 'sum' else o['sum'] / o['count'],
+          'title': o['title'],
+          'author': o['author'],
+          'match': o['match'],
+          'source_year': o['source_year'],
+          'target_year': o['target_year'],
+        })
+      # write the scatterplot data
+      with open(os.path.join(out_dir, '{}-{}-{}.json'.format(i, j, k)), 'w') as out:
+        json.dump(scatterplot_data, out)
 
 
 ##
@@ -790,6 +1400,8 @@ def write_scatterplots(**kwargs):
 def create_reader_data(**kwargs):
   '''Create the data to be used in the reader view'''
   for idx, i in enumerate(kwargs['infiles']):
+    # the texts of files processed by the previous run are already in place
+    if idx < kwargs.get('first_new_file_id', 0): continue
     out_path = os.path.join(kwargs['output'], 'api', 'texts', str(idx) + '.json')
     words = get_words(i, **get_cacheable(kwargs, {'display': True}))
     with open(out_path, 'w') as out:
@@ -806,77 +1418,284 @@ def initialize_db(db_name, **kwargs):
   if kwargs.get('db') == 'sqlite':
     with closing(get_db(db_name, initialize=True, **kwargs)) as db:
       cursor = db.cursor()
-      cursor.execute('DROP TABLE IF EXISTS hashbands;')
-      cursor.execute('DROP TABLE IF EXISTS candidates;')
-      cursor.execute('DROP TABLE IF EXISTS matches;')
-      cursor.execute('CREATE TABLE hashbands (hashband TEXT, file_id INTEGER, window_id INTEGER);')
-      cursor.execute('CREATE TABLE candidates (file_id_a INTEGER, file_id_b INTEGER, window_id_a INTEGER, window_id_b INTEGER, UNIQUE(file_id_a, file_id_b, window_id_a, window_id_b));')
-      cursor.execute('CREATE TABLE matches (file_id_a INTEGER, file_id_b INTEGER, window_id_a INTEGER, window_id_b INTEGER, similarity INTEGER);')
+      if not kwargs.get('first_new_file_id') and not is_resuming(**kwargs):
+        cursor.execute('DROP TABLE IF EXISTS hashbands;')
+        cursor.execute('DROP TABLE IF EXISTS candidates;')
+        cursor.execute('DROP TABLE IF EXISTS matches;')
+        cursor.execute('DROP TABLE IF EXISTS progress;')
+      cursor.execute('CREATE TABLE IF NOT EXISTS hashbands (hashband INTEGER, file_id INTEGER, window_id INTEGER);')
+      cursor.execute('CREATE TABLE IF NOT EXISTS candidates (file_id_a INTEGER, file_id_b INTEGER, window_id_a INTEGER, window_id_b INTEGER, UNIQUE(file_id_a, file_id_b, window_id_a, window_id_b));')
+      cursor.execute('CREATE TABLE IF NOT EXISTS matches (file_id_a INTEGER, file_id_b INTEGER, window_id_a INTEGER, window_id_b INTEGER, similarity INTEGER);')
+      cursor.execute('CREATE TABLE IF NOT EXISTS progress (stage TEXT, unit TEXT, count INTEGER);')
+      if not is_resuming(**kwargs):
+        cursor.execute('DELETE FROM progress;')
   else:
-    for i in ['hashbands', 'candidates', 'matches']:
+    for i in ['hashbands', 'candidates', 'matches', 'progress']:
       path = os.path.join('db', i)
       if not os.path.exists(path):
         os.makedirs(path)
 
 
+def index_hashbands(**kwargs):
+  '''Index the hashbands once they are all loaded so they can be streamed in hashband order'''
+  if kwargs.get('db') != 'sqlite': return
+  if kwargs.get('verbose'): print(' * indexing hashbands')
+  with closing(get_db('hashbands', **kwargs)) as db:
+    db.execute('CREATE INDEX IF NOT EXISTS hashbands_index ON hashbands (hashband, file_id, window_id);')
+    db.commit()
+
+
+def index_matches(**kwargs):
+  '''Index the matches once they are all loaded so each file pair can be fetched without a table scan'''
+  if kwargs.get('db') != 'sqlite': return
+  if kwargs.get('verbose'): print(' * indexing matches')
+  with closing(get_db('matches', **kwargs)) as db:
+    db.execute('CREATE INDEX IF NOT EXISTS matches_index ON matches (file_id_a, file_id_b, window_id_a);')
+    db.commit()
+
+
 def get_db(db_name, initialize=False, **kwargs):
   '''Return a Sqlite DB'''
-  db_location = os.path.join(cache_location, '{}.db'.format(db_name))
+  db_location = os.path.join(kwargs['cache_dir'], '{}.db'.format(db_name))
   db = sqlite3.connect(db_location, uri=True, timeout=2**16)
   if initialize:
-    db.execute('PRAGMA synchronous = EXTRA;') # OFF is fastest
-    db.execute('PRAGMA journal_mode = DELETE;') # WAL is fastest
+    db.execute('PRAGMA journal_mode = WAL;') # persists in the db file
+  db.execute('PRAGMA synchronous = {};'.format(kwargs.get('db_synchronous', 'NORMAL')))
   db.execute('PRAGMA temp_store = 1;')
-  db.execute('PRAGMA temp_store_directory = "{}"'.format(cache_location))
+  db.execute('PRAGMA temp_store_directory = "{}"'.format(kwargs['cache_dir']))
   return db
 
 
+##
+# DB Writer
+##
+
+
+@contextmanager
+def db_writer(**kwargs):
+  '''Run a process that owns one connection per sqlite db and performs all inserts while the context is open'''
+  global db_writer_queue
+  if kwargs.get('db') != 'sqlite':
+    yield
+    return
+  queue = multiprocessing.Queue(maxsize=db_writer_queue_size)
+  process = multiprocessing.Process(target=run_db_writer, args=(queue,), kwargs=kwargs)
+  process.start()
+  db_writer_queue = queue
+  try:
+    yield
+  finally:
+    db_writer_queue = None
+    queue.put(None)
+    process.join()
+  if process.exitcode != 0:
+    raise sqlite3.DatabaseError('the db writer exited with code {}'.format(process.exitcode))
+
+
+def run_db_writer(queue, **kwargs):
+  '''Insert each (db_name, table, rows) batch received on `queue`, committing every `commit_frequency` rows'''
+  dbs = {}
+  uncommitted = defaultdict(int)
+  error = None
+  for db_name, table, rows in iter(queue.get, None):
+    # after an error keep draining the queue so workers never block on a full queue
+    if error: continue
+    try:
+      if db_name not in dbs:
+        dbs[db_name] = get_db(db_name, **kwargs)
+      # progress rows share the transaction of the data they describe
+      insert_rows(dbs[db_name], table, rows)
+      uncommitted[db_name] += len(rows)
+      if uncommitted[db_name] >= kwargs['commit_frequency']:
+        dbs[db_name].commit()
+        uncommitted[db_name] = 0
+    except Exception as exc:
+      error = exc
+  for db in dbs.values():
+    if not error: db.commit()
+    db.close()
+  if error: raise error
+
+
+def set_db_writer_queue(queue):
+  '''Set the queue through which the current process sends rows to the db writer'''
+  global db_writer_queue
+  db_writer_queue = queue
+
+
+def imap_bounded(pool, f, tasks, max_pending=None):
+  '''Yield f(task) for each task in completion order, keeping at most max_pending tasks queued in the pool'''
+  pending = threading.BoundedSemaphore(max_pending or 2 * multiprocessing.cpu_count())
+  stopped = threading.Event()
+  def bounded_tasks():
+    for task in tasks:
+      # the pool can only be terminated once this generator returns, so stop waiting when results stop being read
+      while not pending.acquire(timeout=0.1):
+        if stopped.is_set(): return
+      yield task
+  try:
+    for result in pool.imap_unordered(f, bounded_tasks()):
+      pending.release()
+      yield result
+  finally:
+    stopped.set()
+
+
+def get_tasks(pair_counts, split=False, **kwargs):
+  '''Given [(file_id_a, file_id_b, count)] return lists of file pair args to process, largest first'''
+  pair_counts = sorted(pair_counts, key=lambda i: (-i[2], i[0], i[1]))
+  total = sum(i[2] for i in pair_counts)
+  # aim for several tasks per cpu so the largest tasks can't leave the pool idle
+  task_size = max(1, min(kwargs['batch_size'], math.ceil(total / (multiprocessing.cpu_count() * tasks_per_cpu))))
+  tasks = []
+  task = []
+  size = 0
+  for file_id_a, file_id_b, count in pair_counts:
+    if split and count > task_size:
+      # cut huge pairs into subtasks that each cover an equal range of window_id_a
+      store = get_window_store(file_id_a, kwargs['infiles'][file_id_a], **get_cacheable(kwargs))
+      window_count = get_store_window_count(store, **kwargs)
+      n = min(math.ceil(count / task_size), max(1, window_count))
+      starts = [window_count * i // n for i in range(n)]
+      ends = starts[1:] + [max_window_id]
+      tasks += [[(file_id_a, file_id_b, start, end)] for start, end in zip(starts, ends)]
+    elif count >= task_size:
+      tasks.append([(file_id_a, file_id_b)])
+    else:
+      # pack small pairs together so each task carries about task_size rows
+      task.append((file_id_a, file_id_b))
+      size += count
+      if size >= task_size:
+        tasks.append(task)
+        task = []
+        size = 0
+  if task: tasks.append(task)
+  return tasks
+
+
+def run_task(stage, f, task, **kwargs):
+  '''Call f on each file pair args in a task, recording each as complete, and return the task and its runtime in seconds'''
+  start = time.time()
+  for file_args in task:
+    f(file_args)
+    record_progress(stage, [[get_progress_unit(file_args), 0]], **kwargs)
+  return task, time.time() - start
+
+
+def get_progress_unit(file_args):
+  '''Return the progress unit of file pair args such as [file_id_a, file_id_b] or [file_id_a, file_id_b, start, end]'''
+  return field_delimiter.join(str(i) for i in file_args)
+
+
+def get_progress_ranges(done):
+  '''Given validation progress units return d[(file_id_a, file_id_b)] = [[start, end]] of validated window_id_a ranges'''
+  d = defaultdict(list)
+  for unit in done:
+    file_id_a, file_id_b, start, end = (list(map(int, unit.split(field_delimiter))) + [0, max_window_id])[:4]
+    d[(file_id_a, file_id_b)].append([start, end])
+  return d
+
+
+def remove_completed_ranges(tasks, done):
+  '''Given tasks of file pair args and d[(file_id_a, file_id_b)] = [[start, end]], return tasks without the completed ranges'''
+  if not done: return tasks
+  result = []
+  for task in tasks:
+    remaining = []
+    for file_args in task:
+      file_id_a, file_id_b, start, end = (list(file_args) + [0, max_window_id])[:4]
+      # subtract each completed range from the window range of these args
+      for done_start, done_end in sorted(done.get((file_id_a, file_id_b), [])):
+        if done_end <= start or done_start >= end: continue
+        if done_start > start: remaining.append((file_id_a, file_id_b, start, done_start))
+        start = max(start, done_end)
+      if start < end: remaining.append((file_id_a, file_id_b, start, end))
+    if remaining: result.append(remaining)
+  return result
+
+
+def report_task(verb, task, elapsed):
+  '''Print the runtime of a task'''
+  if len(task) == 1 and len(task[0]) == 4:
+    file_id_a, file_id_b, start, end = task[0]
+    end = '' if end == max_window_id else end
+    print(' * {} file pair {}-{} windows {}:{} in {:.2f}s'.format(verb, file_id_a, file_id_b, start, end, elapsed))
+  else:
+    print(' * {} {} file pairs in {:.2f}s'.format(verb, len(task), elapsed))
+
+
+@contextmanager
+def get_pool():
+  '''Yield a multiprocessing pool whose workers send their inserts to the active db writer, terminating it on error'''
+  pool = multiprocessing.Pool(initializer=set_db_writer_queue, initargs=(db_writer_queue,))
+  try:
+    yield pool
+  except:
+    pool.terminate()
+    pool.join()
+    raise
+  pool.close()
+  pool.join()
+
+
 ##
 # DB Setters
 ##
 
 
+def write_rows(db_name, rows, table=None, **kwargs):
+  '''Send rows to the db writer if one is running, else insert them into the db directly'''
+  table = table or db_name
+  if db_writer_queue is not None:
+    db_writer_queue.put((db_name, table, rows))
+    return
+  try:
+    with closing(get_db(db_name, **kwargs)) as db:
+      insert_rows(db, table, rows)
+      db.commit()
+  except sqlite3.DatabaseError:
+    repair_database(**kwargs)
+    return write_rows(db_name, rows, table, **kwargs)
+
+
+def insert_rows(db, table, rows):
+  '''Insert a list (or structured array) of rows into `table`'''
+  if isinstance(rows, np.ndarray): rows = rows.tolist()
+  db.executemany(insert_statements[table], rows)
+
+
 def write_hashbands(writes, **kwargs):
-  '''Given a db cursor and list of write operations, insert each'''
-  if not writes: return []
+  '''Given a structured array of (band, file_id, window_id) hashbands, insert each'''
+  if not len(writes): return []
   if kwargs.get('db') == 'sqlite':
-    try:
-      if kwargs['verbose']: print(' * writing', len(writes), 'hashbands')
-      with closing(get_db('hashbands', **kwargs)) as db:
-        cursor = db.cursor()
-        cursor.executemany('INSERT INTO hashbands (hashband, file_id, window_id) VALUES (?,?,?);', writes)
-        db.commit()
-    except sqlite3.DatabaseError:
-      repair_database(**kwargs)
-      return write_hashbands(writes, **kwargs)
+    if kwargs['verbose']: print(' * writing', len(writes), 'hashbands')
+    write_rows('hashbands', writes, **kwargs)
+  elif kwargs.get('db') == 'npy':
+    if kwargs['verbose']: print(' * writing', len(writes), 'hashbands')
+    # name each file's run by its file id so a resumed run replaces any run it rewrites
+    write_hashband_run(writes, os.path.join('db', 'hashbands', '{}.npy'.format(writes['file_id'][0])))
   else:
     d = defaultdict(list)
-    for hashband, file_id, window_id in writes:
-      d[hashband].append([file_id, window_id])
-    for hashband in d:
-      out_dir = os.path.join('db', 'hashbands', hashband[0:2])
-      make_dir(out_dir)
-      path = os.path.join(out_dir, hashband[2:4])
+    for hashband, file_id, window_id in writes.tolist():
+      d[get_hashband_path(hashband)].append(field_delimiter.join([str(hashband), str(file_id), str(window_id)]))
+    for path in d:
+      make_dir(os.path.dirname(path))
       with open(path, 'a') as out:
-        s = ''
-        for r in d[hashband]:
-          s += field_delimiter.join([str(v) for v in [hashband] + r]) + row_delimiter
-        out.write(s)
+        out.write(row_delimiter.join(d[path]) + row_delimiter)
+
+
+def get_hashband_path(hashband):
+  '''Given an integer hashband key return the path to the flat file in which it is stored'''
+  h = '{:016x}'.format(hashband)
+  return os.path.join('db', 'hashbands', h[-2:], h[-4:-2])
 
 
 def write_candidates(writes, **kwargs):
   '''Given a db cursor and list of write operations, insert each'''
   if not writes: return
   if kwargs.get('db') == 'sqlite':
-    try:
-      if kwargs['verbose']: print(' * writing', len(writes), 'candidates')
-      with closing(get_db('candidates', **kwargs)) as db:
-        cursor = db.cursor()
-        cursor.executemany('INSERT OR IGNORE INTO candidates (file_id_a, file_id_b, window_id_a, window_id_b) VALUES (?,?,?,?);', writes)
-        db.commit()
-    except sqlite3.DatabaseError:
-      repair_database(**kwargs)
-      return write_candidates(writes, **kwargs)
+    if kwargs['verbose']: print(' * writing', len(writes), 'candidates')
+    write_rows('candidates', list(writes), **kwargs)
   else:
     d = defaultdict(lambda: defaultdict(list))
     for row in writes:
@@ -897,17 +1716,10 @@ def write_candidates(writes, **kwargs):
 def write_matches(writes, **kwargs):
   '''Given a db cursor and list of write operations, insert each'''
   if kwargs.get('db') == 'sqlite':
-    try:
-      if writes:
-        if kwargs['verbose']: print(' * writing', len(writes), 'matches')
-        with closing(get_db('matches', **kwargs)) as db:
-          cursor = db.cursor()
-          cursor.executemany('INSERT INTO matches (file_id_a, file_id_b, window_id_a, window_id_b, similarity) VALUES (?,?,?,?,?);', writes)
-          db.commit()
-      return []
-    except sqlite3.DatabaseError:
-      repair_database(**kwargs)
-      return write_matches(writes, **kwargs)
+    if writes:
+      if kwargs['verbose']: print(' * writing', len(writes), 'matches')
+      write_rows('matches', writes, **kwargs)
+    return []
   else:
     d = defaultdict(lambda: defaultdict(list))
     for row in writes:
@@ -925,30 +1737,87 @@ def write_matches(writes, **kwargs):
           out.write(s)
 
 
+def delete_unfinished_hashbands(done, **kwargs):
+  '''Given the set of file ids whose hashbands are complete, delete the partial hashbands of an interrupted run'''
+  if not is_resuming(**kwargs): return
+  first_new_file_id = kwargs.get('first_new_file_id', 0)
+  if kwargs.get('db') == 'sqlite':
+    with closing(get_db('hashbands', **kwargs)) as db:
+      db.execute('CREATE TEMP TABLE done (file_id INTEGER PRIMARY KEY);')
+      db.executemany('INSERT INTO done (file_id) VALUES (?);', [(i,) for i in done])
+      db.execute('DELETE FROM hashbands WHERE file_id >= ? AND file_id NOT IN (SELECT file_id FROM done);', (first_new_file_id,))
+      db.commit()
+  elif kwargs.get('db') != 'npy':
+    # npy runs are named by file id, so they are simply replaced when their file is hashed again
+    for path in glob.glob(os.path.join('db', 'hashbands', '*', '*')):
+      with open(path) as f:
+        rows = [i for i in f.read().split(row_delimiter) if i]
+      kept = [i for i in rows if int(i.split(field_delimiter)[1]) < first_new_file_id or int(i.split(field_delimiter)[1]) in done]
+      if len(kept) < len(rows):
+        with open(path, 'w') as out:
+          out.write(''.join(i + row_delimiter for i in kept))
+
+
+def delete_unfinished_matches(done, **kwargs):
+  '''Given d[(file_id_a, file_id_b)] = [[start, end]] of validated window_id_a ranges, delete the partial matches of an interrupted run'''
+  if not is_resuming(**kwargs): return
+  first_new_file_id = kwargs.get('first_new_file_id', 0)
+  if kwargs.get('db') == 'sqlite':
+    with closing(get_db('matches', **kwargs)) as db:
+      db.execute('CREATE TEMP TABLE done (file_id_a INTEGER, file_id_b INTEGER, start INTEGER, end INTEGER);')
+      db.executemany('INSERT INTO done VALUES (?,?,?,?);', [k + tuple(i) for k, v in done.items() for i in v])
+      db.execute('''
+        DELETE FROM matches
+        WHERE file_id_b >= ? AND NOT EXISTS (
+          SELECT 1 FROM done
+          WHERE done.file_id_a = matches.file_id_a AND done.file_id_b = matches.file_id_b
+            AND matches.window_id_a >= done.start AND matches.window_id_a < done.end
+        );
+      ''', (first_new_file_id,))
+      db.commit()
+  else:
+    for file_id_a, file_id_b in stream_matching_file_id_pairs(**kwargs):
+      if file_id_b < first_new_file_id: continue
+      ranges = done.get((file_id_a, file_id_b), [])
+      path = os.path.join('db', 'matches', str(file_id_a), str(file_id_b))
+      with open(path) as f:
+        rows = [i for i in f.read().split(row_delimiter) if i]
+      kept = [i for i in rows if any(start <= int(i.split(field_delimiter)[0]) < end for start, end in ranges)]
+      if len(kept) < len(rows):
+        with open(path, 'w') as out:
+          out.write(''.join(i + row_delimiter for i in kept))
+
+
 def delete_matches(banished_dict, **kwargs):
-  '''Given d[file_id] = [window_id], delete all specified windows'''
+  '''Given d[file_id] = [window_id], delete all matches that include a specified window'''
+  if kwargs['verbose']: print(' * deleting the matches of', sum(len(i) for i in banished_dict.values()), 'windows')
   if kwargs.get('db') == 'sqlite':
-    deletes = []
-    for file_id, window_ids in banished_dict.items():
-      deletes += [(file_id, i, file_id, i) for i in window_ids]
-    if kwargs['verbose']: print(' * deleting', len(deletes), 'matches')
     with closing(get_db('matches', **kwargs)) as db:
-      cursor = db.cursor()
-      cursor.executemany('DELETE FROM matches WHERE file_id_a = (?) AND window_id_a = (?) OR file_id_b = (?) and window_id_b = (?) ', deletes)
+      db.execute('CREATE TEMP TABLE banished (file_id INTEGER, window_id INTEGER, PRIMARY KEY (file_id, window_id)) WITHOUT ROWID;')
+      db.executemany('INSERT INTO banished VALUES (?,?);', [(k, i) for k, v in banished_dict.items() for i in v])
+      # one pass over the matches, with an indexed lookup of each window in the banished table
+      db.execute('''
+        DELETE FROM matches
+        WHERE EXISTS (SELECT 1 FROM banished WHERE banished.file_id = matches.file_id_a AND banished.window_id = matches.window_id_a)
+          OR EXISTS (SELECT 1 FROM banished WHERE banished.file_id = matches.file_id_b AND banished.window_id = matches.window_id_b);
+      ''')
       db.commit()
   else:
-    for file_id in banished_dict:
-      files = glob.glob(os.path.join('db', 'matches', file_id, '*'))
-      for i in files:
-        with open(i) as f:
-          lines = []
-          for l in f.read().strip().split(row_delimiter):
-            window_id_a, window_id_b, sim = l.split(field_delimiter)
-            if window_id_a not in banished_dict[file_id]:
-              lines.append(l)
-        # write the cleaned lines to disk
-        with open(i, 'w') as out:
-          out.write(row_delimiter.join(lines))
+    empty = set()
+    for file_id_a, file_id_b in list(stream_matching_file_id_pairs(**kwargs)):
+      if file_id_a not in banished_dict and file_id_b not in banished_dict: continue
+      banished_a = banished_dict.get(file_id_a, empty)
+      banished_b = banished_dict.get(file_id_b, empty)
+      path = os.path.join('db', 'matches', str(file_id_a), str(file_id_b))
+      # stream the cleaned rows to a hidden temp file, which globs skip, then swap it into place
+      tmp_path = os.path.join('db', 'matches', str(file_id_a), '.{}.tmp'.format(file_id_b))
+      with open(path) as f, open(tmp_path, 'w') as out:
+        for row in f:
+          if not row.strip(): continue
+          window_id_a, window_id_b, sim = row.rstrip(row_delimiter).split(field_delimiter)
+          if int(window_id_a) not in banished_a and int(window_id_b) not in banished_b:
+            out.write(row.rstrip(row_delimiter) + row_delimiter)
+      os.replace(tmp_path, path)
 
 
 def repair_database(**kwargs):
@@ -967,17 +1836,24 @@ def stream_hashbands(**kwargs):
   if kwargs.get('db') == 'sqlite':
     with closing(get_db('hashbands', **kwargs)) as db:
       cursor = db.cursor()
-      for row in cursor.execute('''
-        WITH file_id_counts AS (
-          SELECT hashband, COUNT(DISTINCT(file_id)) as count
-          FROM hashbands
-          GROUP BY hashband
-          HAVING COUNT > 1
-        ) SELECT hashband, file_id, window_id
-          FROM hashbands
-          WHERE hashband IN (SELECT hashband from file_id_counts)
-          ORDER BY hashband
-      '''):
+      if kwargs.get('first_new_file_id'):
+        # only read the hashbands that occur in the rows added since the previous run
+        rows = cursor.execute('''
+          SELECT hashband, file_id, window_id FROM hashbands
+          WHERE hashband IN (SELECT hashband FROM hashbands WHERE rowid > ?)
+          ORDER BY hashband;
+        ''', (kwargs['state']['hashband_rowid'],))
+      else:
+        # read the hashbands_index in order once, retaining only hashbands that occur in multiple files
+        rows = cursor.execute('SELECT hashband, file_id, window_id FROM hashbands ORDER BY hashband;')
+      for hashband, group in groupby(rows, key=lambda row: row[0]):
+        group = list(group)
+        if any(row[1] != group[0][1] for row in group):
+          for row in group:
+            yield row
+  elif kwargs.get('db') == 'npy':
+    for block in filter_hashband_blocks(merge_hashband_runs(**kwargs), kwargs.get('first_new_file_id', 0)):
+      for row in block.tolist():
         yield row
   else:
     for i in glob.glob(os.path.join('db', 'hashbands', '*', '*')):
@@ -988,10 +1864,10 @@ def stream_hashbands(**kwargs):
       for row in f.split(row_delimiter):
         if not row: continue
         hashband, file_id, window_id = row.split(field_delimiter)
-        d[hashband].append([int(file_id), int(window_id)])
+        d[int(hashband)].append([int(file_id), int(window_id)])
       for hashband in d:
         file_ids, window_ids = zip(*d[hashband])
-        if len(set(file_ids)) > 1:
+        if len(set(file_ids)) > 1 and max(file_ids) >= kwargs.get('first_new_file_id', 0):
           for j in d[hashband]:
             yield [hashband] + j
 
@@ -1016,25 +1892,60 @@ def stream_candidate_file_id_pairs(**kwargs):
         yield [int(file_id_a), int(file_id_b)]
 
 
-def stream_matching_candidate_windows(file_id_a, file_id_b, **kwargs):
-  '''Stream [file_id_a, file_id_b, window_id_a, window_id_b] for matching hashbands'''
+def stream_matching_candidate_windows(file_id_a, file_id_b, window_range=None, **kwargs):
+  '''Stream [file_id_a, file_id_b, window_id_a, window_id_b] for matching hashbands, optionally with window_id_a in [start, end)'''
   if kwargs.get('verbose'): print(' * querying for matching candidate windows')
+  start, end = window_range or (0, max_window_id)
   if kwargs.get('db') == 'sqlite':
     with closing(get_db('candidates', **kwargs)) as db:
       cursor = db.cursor()
       for i in cursor.execute('''
           SELECT DISTINCT file_id_a, file_id_b, window_id_a, window_id_b
           FROM candidates
-          WHERE file_id_a = ? AND file_id_b = ?
+          WHERE file_id_a = ? AND file_id_b = ? AND window_id_a >= ? AND window_id_a < ?
           ORDER BY file_id_b
-        ''', (file_id_a, file_id_b,)):
+        ''', (file_id_a, file_id_b, start, end,)):
         yield i
   else:
     with open(os.path.join('db', 'candidates', str(file_id_a), str(file_id_b))) as f:
       f = f.read()
     for row in f.split(row_delimiter):
       if not row: continue
-      yield [int(file_id_a), int(file_id_b)] + [int(i) for i in row.split(field_delimiter)]
+      window_id_a, window_id_b = [int(i) for i in row.split(field_delimiter)]
+      if start <= window_id_a < end:
+        yield [int(file_id_a), int(file_id_b), window_id_a, window_id_b]
+
+
+def stream_candidate_pair_counts(**kwargs):
+  '''Stream [file_id_a, file_id_b, count] with the number of candidate windows of each file pair'''
+  if kwargs.get('db') == 'sqlite':
+    with closing(get_db('candidates', **kwargs)) as db:
+      cursor = db.cursor()
+      for i in cursor.execute('SELECT file_id_a, file_id_b, COUNT(*) FROM candidates GROUP BY file_id_a, file_id_b;'):
+        yield i
+  else:
+    for file_id_a, file_id_b in stream_candidate_file_id_pairs(**kwargs):
+      yield [file_id_a, file_id_b, count_rows(os.path.join('db', 'candidates', str(file_id_a), str(file_id_b)))]
+
+
+def stream_match_pair_counts(**kwargs):
+  '''Stream [file_id_a, file_id_b, count] with the number of matches of each file pair'''
+  if kwargs.get('db') == 'sqlite':
+    with closing(get_db('matches', **kwargs)) as db:
+      cursor = db.cursor()
+      for i in cursor.execute('SELECT file_id_a, file_id_b, COUNT(*) FROM matches GROUP BY file_id_a, file_id_b;'):
+        if i[1] >= kwargs.get('first_changed_file_id', 0):
+          yield i
+  else:
+    for file_id_a, file_id_b in stream_matching_file_id_pairs(**kwargs):
+      if file_id_b >= kwargs.get('first_changed_file_id', 0):
+        yield [file_id_a, file_id_b, count_rows(os.path.join('db', 'matches', str(file_id_a), str(file_id_b)))]
+
+
+def count_rows(path):
+  '''Return the number of rows in a flat file'''
+  with open(path) as f:
+    return f.read().count(row_delimiter)
 
 
 def stream_matching_file_id_pairs(**kwargs):
@@ -1076,6 +1987,112 @@ def stream_match_lists(**kwargs):
       yield (file_id, match_list)
 
 
+##
+# Hashband runs
+##
+
+
+def write_hashband_run(hashbands, path):
+  '''Save a structured array of hashbands sorted by band as a binary run at `path`'''
+  make_dir(os.path.dirname(path))
+  hashbands = hashbands[np.argsort(hashbands['band'], kind='stable')]
+  # write to a temp file first so a partially written run is never merged
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as out:
+    np.save(out, hashbands)
+  os.replace(tmp_path, path)
+
+
+def merge_hashband_runs(**kwargs):
+  '''Yield blocks of hashbands in band order by merging all runs within the memory budget'''
+  paths = sorted(glob.glob(os.path.join('db', 'hashbands', '*.npy')))
+  budget = kwargs['memory_budget'] * 2**20 // hashband_dtype.itemsize
+  # each run needs a buffer of at least min_run_buffer rows (plus the same again for the merged output)
+  max_runs = max(2, budget // (2 * min_run_buffer))
+  spill_dir = os.path.join(kwargs.get('spill_dir') or os.path.join('db', 'spill'), uuid.uuid4().hex)
+  spilled = []
+  try:
+    # merge groups of runs into longer runs on disk until all runs can be merged at once
+    while len(paths) > max_runs:
+      if kwargs.get('verbose'): print(' * merging', len(paths), 'hashband runs')
+      merged = []
+      for i in range(0, len(paths), max_runs):
+        path = os.path.join(spill_dir, '{}.npy'.format(len(spilled)))
+        write_merged_run(paths[i:i + max_runs], path, budget)
+        merged.append(path)
+        spilled.append(path)
+      paths = merged
+    for block in merge_runs(paths, budget):
+      yield block
+  finally:
+    for path in spilled:
+      os.remove(path)
+    if os.path.exists(spill_dir):
+      shutil.rmtree(spill_dir)
+
+
+def merge_runs(paths, budget):
+  '''Given paths to hashband runs sorted by band and a budget in rows, yield merged blocks in band order'''
+  if not paths: return
+  runs = [np.load(path, mmap_mode='r') for path in paths]
+  buffer_size = max(1, budget // (2 * len(runs)))
+  offsets = [0 for _ in runs]
+  buffers = [np.empty(0, dtype=hashband_dtype) for _ in runs]
+  while True:
+    # refill each empty buffer with the next slice of its memory-mapped run
+    for i, run in enumerate(runs):
+      if not len(buffers[i]) and offsets[i] < len(run):
+        buffers[i] = np.array(run[offsets[i]:offsets[i] + buffer_size])
+        offsets[i] += len(buffers[i])
+    active = [i for i in buffers if len(i)]
+    if not active: return
+    # every buffered row with band <= the smallest final band among the buffers can be emitted in order
+    cutoff = min(i['band'][-1] for i in active)
+    block = []
+    for i, buffer in enumerate(buffers):
+      n = np.searchsorted(buffer['band'], cutoff, side='right')
+      block.append(buffer[:n])
+      buffers[i] = buffer[n:]
+    block = np.concatenate(block)
+    yield block[np.argsort(block['band'], kind='stable')]
+
+
+def write_merged_run(paths, path, budget):
+  '''Merge the hashband runs at `paths` into a single run at `path`'''
+  make_dir(os.path.dirname(path))
+  size = sum(len(np.load(i, mmap_mode='r')) for i in paths)
+  out = np.lib.format.open_memmap(path, mode='w+', dtype=hashband_dtype, shape=(size,))
+  offset = 0
+  for block in merge_runs(paths, budget):
+    out[offset:offset + len(block)] = block
+    offset += len(block)
+  out.flush()
+  del out
+
+
+def filter_hashband_blocks(blocks, first_new_file_id=0):
+  '''Given blocks of hashbands in band order, yield blocks with only the hashbands that occur in multiple files'''
+  carry = np.empty(0, dtype=hashband_dtype)
+  for block in blocks:
+    block = np.concatenate([carry, block])
+    # hold back the final hashband, as its rows may continue in the next block
+    last = np.searchsorted(block['band'], block['band'][-1], side='left')
+    carry = block[last:]
+    yield get_multi_file_hashbands(block[:last], first_new_file_id)
+  yield get_multi_file_hashbands(carry, first_new_file_id)
+
+
+def get_multi_file_hashbands(hashbands, first_new_file_id=0):
+  '''Given hashbands sorted by band, return the rows of the bands that occur in more than one file (and any new file)'''
+  if not len(hashbands): return hashbands
+  starts = np.flatnonzero(np.concatenate([[True], hashbands['band'][1:] != hashbands['band'][:-1]]))
+  lengths = np.diff(np.append(starts, len(hashbands)))
+  file_ids = hashbands['file_id']
+  max_file_ids = np.maximum.reduceat(file_ids, starts)
+  multi_file = (np.minimum.reduceat(file_ids, starts) != max_file_ids) & (max_file_ids >= first_new_file_id)
+  return hashbands[np.repeat(multi_file, lengths)]
+
+
 ##
 # Banishing matches
 ##
@@ -1085,44 +2102,196 @@ def banish_matches(**kwargs):
   '''Delete banished matches from the db'''
   if not kwargs['banish_glob']: return
   print(' * banishing matches')
-  g = networkx.Graph()
-  for file_id_a, file_id_b in stream_matching_file_id_pairs(**kwargs):
-    l = stream_file_pair_matches(file_id_a, file_id_b, **kwargs)
-    for _, _, window_a, window_b, sim in l:
-      s = '{}.{}'.format(file_id_a, window_a)
-      t = '{}.{}'.format(file_id_b, window_b)
-      g.add_edge(s, t)
+  nodes, indptr, indices = get_match_graph(**kwargs)
+  # find the nodes within banish_distance of a window in a banished file
+  sources = np.flatnonzero(np.isin(nodes >> window_id_bits, kwargs['banished_file_ids']))
+  banished = nodes[get_nodes_within_distance(indptr, indices, sources, kwargs['banish_distance'])]
   # create d[file_id] = [window_id, window_id] of banished windows
   banished_dict = defaultdict(set)
-  distances = dict(networkx.all_pairs_shortest_path_length(g))
-  for i in list(connected_components(g)):
-    banished_ids = [j for j in i if int(j.split('.')[0]) in kwargs['banished_file_ids']]
-    # search up to maximum path length between nodes so nodes linked to a banished node are removed
-    for j in i:
-      if any([distances[j][k] < kwargs['banish_distance'] for k in banished_ids]):
-        file_id, window_id = j.split('.')
-        banished_dict[file_id].add(window_id)
+  for file_id, window_id in zip((banished >> window_id_bits).tolist(), (banished & window_id_mask).tolist()):
+    banished_dict[file_id].add(window_id)
   # remove the banished file_id, window_id tuples from the db
   delete_matches(banished_dict, **kwargs)
 
 
-def to_graph(l):
-  '''Given a 2D array, return a networkx.Graph object'''
-  G = networkx.Graph()
-  # i is a list of nodes that share edges
-  for i in l:
-    G.add_nodes_from(i)
-    G.add_edges_from(to_edges(i))
-  return G
+def get_match_graph(**kwargs):
+  '''Return [nodes, indptr, indices] where nodes are file_id << window_id_bits | window_id and edges are in CSR form'''
+  edges_a, edges_b = [], []
+  for file_id_a, file_id_b in stream_matching_file_id_pairs(**kwargs):
+    rows = np.array(list(stream_file_pair_matches(file_id_a, file_id_b, **kwargs)), dtype=np.int64)
+    if not len(rows): continue
+    edges_a.append((rows[:,0] << window_id_bits) | rows[:,2])
+    edges_b.append((rows[:,1] << window_id_bits) | rows[:,3])
+  if not edges_a:
+    return [np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64)]
+  edges_a = np.concatenate(edges_a)
+  edges_b = np.concatenate(edges_b)
+  # map each node to a dense int id, then store each undirected edge in both directions
+  nodes, ids = np.unique(np.concatenate([edges_a, edges_b]), return_inverse=True)
+  heads = np.concatenate([ids[:len(edges_a)], ids[len(edges_a):]])
+  tails = np.concatenate([ids[len(edges_a):], ids[:len(edges_a)]])
+  order = np.argsort(heads, kind='stable')
+  indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+  np.cumsum(np.bincount(heads, minlength=len(nodes)), out=indptr[1:])
+  return [nodes, indptr, tails[order]]
+
+
+def get_nodes_within_distance(indptr, indices, sources, distance):
+  '''Return the sorted ids of nodes fewer than `distance` edges from any of `sources`'''
+  visited = np.zeros(len(indptr) - 1, dtype=bool)
+  frontier = np.unique(sources)
+  for _ in range(distance):
+    if not len(frontier): break
+    visited[frontier] = True
+    neighbors = get_neighbors(indptr, indices, frontier)
+    frontier = np.unique(neighbors[~visited[neighbors]])
+  return np.flatnonzero(visited)
+
+
+def get_neighbors(indptr, indices, nodes):
+  '''Return the ids of all nodes adjacent to `nodes` in a CSR graph'''
+  starts = indptr[nodes]
+  counts = indptr[nodes + 1] - starts
+  # offset of each neighbor within its node's slice of `indices`
+  offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+  return indices[np.repeat(starts, counts) + offsets]
+
+
+##
+# Cache
+##
+
+
+def get_cache_key(file_path, params):
+  '''Return a key that identifies the content of a file and the params used to process it'''
+  h = hashlib.sha1(get_file_digest(file_path).encode('utf8'))
+  h.update(json.dumps(params, sort_keys=True).encode('utf8'))
+  return h.hexdigest()
 
 
-def to_edges(l):
-  '''Given a list of elements that share edges in a graph, iterate those edges pairwise'''
-  iterator = iter(l)
-  last = next(iterator)
-  for current in iterator:
-    yield last, current
-    last = current
+def get_file_digest(file_path):
+  '''Return the sha1 hex digest of the bytes in a file'''
+  h = hashlib.sha1()
+  with open(file_path, 'rb') as f:
+    for chunk in iter(lambda: f.read(2**20), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def get_cache_path(kind, filename, **kwargs):
+  '''Return the path to a cache entry of type `kind`'''
+  return os.path.join(kwargs['cache_dir'], kind, filename)
+
+
+def get_cache_index(**kwargs):
+  '''Return a connection to the db that records the size and last access time of each cache entry'''
+  db = sqlite3.connect(os.path.join(kwargs['cache_dir'], 'index.db'), timeout=2**16)
+  db.execute('CREATE TABLE IF NOT EXISTS entries (path TEXT PRIMARY KEY, size INTEGER, accessed REAL);')
+  return db
+
+
+def write_cache_entry(path, write, **kwargs):
+  '''Call write(file_handle) to store a cache entry at `path`, then record it in the cache index'''
+  make_dir(os.path.dirname(path))
+  # write to a temp file first so other processes never read a partial entry
+  tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+  with open(tmp_path, 'wb') as out:
+    write(out)
+  os.replace(tmp_path, path)
+  with closing(get_cache_index(**kwargs)) as db:
+    db.execute('INSERT OR REPLACE INTO entries (path, size, accessed) VALUES (?,?,?);', (
+      os.path.relpath(path, kwargs['cache_dir']),
+      os.path.getsize(path),
+      time.time(),
+    ))
+    db.commit()
+  evict_cache(path, **kwargs)
+
+
+def touch_cache_entry(path, **kwargs):
+  '''Mark a cache entry as recently used'''
+  with closing(get_cache_index(**kwargs)) as db:
+    db.execute('UPDATE entries SET accessed = ? WHERE path = ?;', (time.time(), os.path.relpath(path, kwargs['cache_dir'])))
+    db.commit()
+
+
+def evict_cache(keep_path, **kwargs):
+  '''Remove the least recently used cache entries until the cache fits within `cache_size` MB'''
+  if kwargs.get('cache_size') is None: return
+  max_size = kwargs['cache_size'] * 2**20
+  keep_path = os.path.relpath(keep_path, kwargs['cache_dir'])
+  with closing(get_cache_index(**kwargs)) as db:
+    size = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries;').fetchone()[0]
+    if size <= max_size: return
+    evicted = []
+    for path, entry_size in db.execute('SELECT path, size FROM entries ORDER BY accessed ASC;').fetchall():
+      if size <= max_size: break
+      if path == keep_path: continue
+      try:
+        os.remove(os.path.join(kwargs['cache_dir'], path))
+      except OSError:
+        pass
+      evicted.append((path,))
+      size -= entry_size
+    db.executemany('DELETE FROM entries WHERE path = ?;', evicted)
+    db.commit()
+    if kwargs.get('verbose'): print(' * evicted', len(evicted), 'cache entries')
+
+
+##
+# Window store
+##
+
+
+def write_window_store(file_id, path, **kwargs):
+  '''Save the analysis and display words of a file as flat UTF-8 arrays with word offsets in db/windows'''
+  out_dir = os.path.join('db', 'windows')
+  make_dir(out_dir)
+  for display in [False, True]:
+    words = get_words(path, **dict(kwargs, display=display))
+    blob = ' '.join(words).encode('utf8')
+    # offsets[i] is the byte offset of word i; offsets[-1] points one byte past the end of the last word
+    lengths = np.array([len(w.encode('utf8')) + 1 for w in words], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    for name, arr in [['words', np.frombuffer(blob, dtype=np.uint8)], ['offsets', offsets]]:
+      out_path = get_window_store_path(file_id, name, display)
+      # write to a temp file first so a concurrent reader never maps a partial array
+      tmp_path = '{}.{}.tmp'.format(out_path, os.getpid())
+      with open(tmp_path, 'wb') as out:
+        np.save(out, arr)
+      os.replace(tmp_path, out_path)
+
+
+def get_window_store_path(file_id, name, display):
+  '''Return the path to one array in the window store of a file'''
+  return os.path.join('db', 'windows', '{}.{}{}.npy'.format(file_id, 'display.' if display else '', name))
+
+
+@functools.lru_cache(maxsize=128)
+def get_window_store(file_id, path, display=False, **kwargs):
+  '''Return (words, offsets) memory-mapped arrays for a file, creating them if necessary'''
+  if not os.path.exists(get_window_store_path(file_id, 'offsets', display)):
+    write_window_store(file_id, path, **kwargs)
+  return tuple(np.load(get_window_store_path(file_id, i, display), mmap_mode='r') for i in ['words', 'offsets'])
+
+
+def get_store_words(store, start, end):
+  '''Return the list of words [start:end] from a window store'''
+  words, offsets = store
+  start = min(max(start, 0), len(offsets) - 1)
+  end = min(max(end, start), len(offsets) - 1)
+  if start == end: return []
+  return bytes(words[offsets[start]:offsets[end] - 1]).decode('utf8').split(' ')
+
+
+def get_store_window(store, window_id, **kwargs):
+  '''Return the string content of a window from a window store'''
+  return ' '.join(get_store_words(store, window_id * kwargs['slide_length'], window_id * kwargs['slide_length'] + kwargs['window_length']))
+
+
+def get_store_window_count(store, **kwargs):
+  '''Return the number of windows in a window store'''
+  return len(range(0, len(store[1]) - kwargs['window_length'], kwargs['slide_length']))
 
 
 ##
@@ -1133,29 +2302,93 @@ def to_edges(l):
 @functools.lru_cache(maxsize=1024)
 def get_words(path, **kwargs):
   '''Given a file path return a list of strings from that file'''
+  words, display_words, page_starts = get_file_tokens(path, **kwargs)
+  return display_words if kwargs.get('display', False) else words
+
+
+def get_file_tokens(path, **kwargs):
+  '''Given a file path return [words, display words, page starts], parsing the file only if its tokens are not cached'''
+  params = {k: kwargs.get(k) for k in words_cache_params}
+  tokens_path = get_cache_path('words', get_cache_key(path, params) + '.tokens', **kwargs)
+  if os.path.exists(tokens_path):
+    try:
+      with open(tokens_path, 'rb') as f:
+        tokens = read_tokens(f.read())
+      touch_cache_entry(tokens_path, **kwargs)
+      return tokens
+    except OSError:
+      # the entry was evicted by another process - parse the file again
+      pass
   with get_file_handler(path, **kwargs) as f:
     if kwargs['xml_base_tag']:
-      soup = get_soup(f, **kwargs)
-      f = soup.get_text() if soup else ''
+      f, page_breaks = get_xml_text(f, **kwargs)
     else:
-      f = f.read()
+      f, page_breaks = f.read(), []
+  tokens = [get_analysis_words(f, **kwargs), get_display_words(f), get_page_starts(f, page_breaks, **kwargs)]
+  write_cache_entry(tokens_path, lambda out: out.write(format_tokens(tokens)), **kwargs)
+  return tokens
+
+
+def get_analysis_words(f, **kwargs):
+  '''Given the text of a file return the list of words to be minhashed and compared'''
   # optionally remove diacritics
-  if kwargs['strip_diacritics'] and not kwargs.get('display', False):
+  if kwargs['strip_diacritics']:
     f = unidecode(f)
-  # optionally format the list of words for display in the web viewer
-  if kwargs.get('display', False):
-    NEWLINE = '__NEWLINE__'
-    l = f.replace('\n', ' ' + NEWLINE + ' ').split()
-    formatted = []
-    for idx, i in enumerate(l):
-      if i == NEWLINE:
-        # prevent more than two consecutive brs
-        if formatted and not formatted[-1].endswith('<br/><br/>'): formatted[-1] += '<br/>'
-      else:
-        formatted.append(i)
-    return formatted
-  else:
-    return f.split()
+  return f.split()
+
+
+def get_display_words(f):
+  '''Given the text of a file return the list of words formatted for display in the web viewer'''
+  NEWLINE = '__NEWLINE__'
+  l = f.replace('\n', ' ' + NEWLINE + ' ').split()
+  formatted = []
+  for idx, i in enumerate(l):
+    if i == NEWLINE:
+      # prevent more than two consecutive brs
+      if formatted and not formatted[-1].endswith('<br/><br/>'): formatted[-1] += '<br/>'
+    else:
+      formatted.append(i)
+  return formatted
+
+
+def get_page_starts(f, page_breaks, **kwargs):
+  '''Given the text of a file and [[offset, page id]] of its page breaks return [[word index, page id]] of the first word of each page'''
+  page_starts = []
+  word_count = 0
+  # a word that spans a page break is counted once, in the page where it starts
+  in_word = False
+  for (start, _), (end, page_id) in zip([[0, None]] + page_breaks, page_breaks + [[len(f), None]]):
+    segment = f[start:end]
+    if kwargs['strip_diacritics']:
+      segment = unidecode(segment)
+    if segment:
+      word_count += len(segment.split()) - int(in_word and not segment[0].isspace())
+      in_word = not segment[-1].isspace()
+    if page_id is not None:
+      page_starts.append([word_count, page_id])
+  return page_starts
+
+
+def format_tokens(tokens):
+  '''Given [words, display words, page starts] return the bytes of a token cache entry'''
+  # words never contain whitespace, so each word is a line and an empty line separates each section
+  return row_delimiter.join([
+    row_delimiter.join(tokens[0]),
+    '',
+    row_delimiter.join(tokens[1]),
+    '',
+    json.dumps(tokens[2]),
+  ]).encode('utf8')
+
+
+def read_tokens(b):
+  '''Given the bytes of a token cache entry return [words, display words, page starts]'''
+  words, display_words, page_starts = b.decode('utf8').split(row_delimiter * 2, 2)
+  return [
+    words.split(row_delimiter) if words else [],
+    display_words.split(row_delimiter) if display_words else [],
+    json.loads(page_starts),
+  ]
 
 
 def get_file_handler(path, **kwargs):
@@ -1163,18 +2396,80 @@ def get_file_handler(path, **kwargs):
   return codecs.open(path, 'r', kwargs['encoding'])
 
 
-def get_soup(f, **kwargs):
-  '''Return a soup object given a _io.TextIOWrapper object'''
-  soup = BeautifulSoup(f, 'html.parser').find(kwargs['xml_base_tag'].lower())
-  if not soup:
+def get_xml_text(f, **kwargs):
+  '''Return [text, [[offset, page id]]] with the text within xml_base_tag and the offset in that text of each page break'''
+  parser = XMLTextParser(**kwargs)
+  for chunk in iter(lambda: f.read(2**20), ''):
+    parser.feed(chunk)
+    if parser.done: break
+  parser.close()
+  if not parser.found:
     print('WARNING: No XML content was found at tag', kwargs['xml_base_tag'].lower(), f.name)
-    return ''
-  # remove any specified xml tags
-  if kwargs.get('xml_remove_tags'):
-    for i in kwargs['xml_remove_tags']:
-      for t in soup.find_all(i.lower()):
-        t.extract()
-  return soup
+  return [''.join(parser.text), [[offset, parser.page_ids[i]] for offset, i in parser.page_breaks]]
+
+
+class XMLTextParser(HTMLParser):
+  '''Collect the text within the first xml_base_tag, skipping xml_remove_tags and noting each xml_page_tag'''
+
+  def __init__(self, **kwargs):
+    super().__init__(convert_charrefs=True)
+    self.base_tag = kwargs['xml_base_tag'].lower()
+    self.remove_tags = set(i.lower() for i in kwargs.get('xml_remove_tags') or [])
+    self.page_tag = (kwargs.get('xml_page_tag') or '').lower()
+    self.page_attr = (kwargs.get('xml_page_attr') or '').lower()
+    self.text = [] # strings within the base tag
+    self.length = 0 # characters in self.text
+    self.page_breaks = [] # [offset, page index] of each page tag
+    self.page_ids = [] # id of each page by page index
+    self.page_text = None # strings within the open page tag, which identify the page if no page attr is given
+    self.found = False # whether the base tag was opened
+    self.done = False # whether the base tag was closed
+    self.depth = 0 # open base tags
+    self.removed = Counter() # open remove tags by tag
+
+  def handle_starttag(self, tag, attrs):
+    if self.done: return
+    if tag == self.base_tag:
+      self.found = True
+      self.depth += 1
+    elif tag in self.remove_tags and self.depth:
+      self.removed[tag] += 1
+    if tag == self.page_tag and self.depth and not sum(self.removed.values()):
+      self.add_page(dict(attrs))
+      if not self.page_attr: self.page_text = []
+
+  def handle_startendtag(self, tag, attrs):
+    if tag == self.page_tag and self.depth and not self.done and not sum(self.removed.values()):
+      self.add_page(dict(attrs))
+
+  def handle_endtag(self, tag):
+    if self.done: return
+    if tag == self.page_tag and self.page_text is not None:
+      self.page_ids[-1] = ''.join(self.page_text).strip()
+      self.page_text = None
+    if tag == self.base_tag and self.depth:
+      self.depth -= 1
+      self.done = not self.depth
+    elif self.removed[tag]:
+      self.removed[tag] -= 1
+
+  def handle_data(self, data):
+    if not self.depth or self.done or sum(self.removed.values()): return
+    self.text.append(data)
+    self.length += len(data)
+    if self.page_text is not None: self.page_text.append(data)
+
+  def unknown_decl(self, data):
+    # CDATA sections are text
+    if data.startswith('CDATA['): self.handle_data(data[len('CDATA['):])
+
+  def add_page(self, attrs):
+    '''Note a page break at the current offset, identified by the page attr or else by the page index'''
+    # a page that is still open without its closing tag is identified by its index
+    self.page_text = None
+    page_id = attrs.get(self.page_attr) if self.page_attr else None
+    self.page_breaks.append([self.length, len(self.page_ids)])
+    self.page_ids.append(str(page_id if page_id is not None else len(self.page_ids)).strip())
 
 
 @functools.lru_cache(maxsize=1024)
@@ -1182,58 +2477,24 @@ def get_windows(path, **kwargs):
   '''Given a file path return a list of strings from that file'''
   words = get_words(path, **kwargs)
   l = []
-  for idx, window in enumerate(list(ngrams(words, kwargs['window_length']))):
-    if idx % kwargs['slide_length'] != 0:
-      continue
-    l.append(' '.join(window))
+  for idx in range(0, len(words) - kwargs['window_length'] + 1, kwargs['slide_length']):
+    l.append(' '.join(words[idx:idx + kwargs['window_length']]))
   return l
 
 
 @functools.lru_cache(maxsize=1024)
 def get_window_map(path, **kwargs):
-  '''Get a mapping from window id to window metadata, including page id'''
-  xml_page_tag = kwargs.get('xml_page_tag')
-  xml_page_attr = kwargs.get('xml_page_attr')
-  if not xml_page_tag: return
-  xml_page_tag = xml_page_tag.lower()
-  xml_page_attr = xml_page_attr.lower() if xml_page_attr else None
-  # read the text document
-  with get_file_handler(path, **kwargs) as f:
-    f = f.read().lower()
-  # split on page breaks using string operations
-  pagebreak = '{}_$PB$_{}'.format(random.randint(0, 2**32), random.randint(0, 2**32)).lower()
-  f = f.replace('<{} '.format(xml_page_tag), pagebreak)
-  f = f.replace('<{}/>'.format(xml_page_tag), pagebreak)
-  pages = f.split(pagebreak)
-  # populate the mapping from window index to page id d[window_index] = {page_id, ...}
+  '''Get a mapping from window id to the page id of the window's first word'''
+  if not kwargs.get('xml_page_tag'): return
+  words, _, page_starts = get_file_tokens(path, **kwargs)
+  # populate the mapping from window index to page id d[window_index] = page_id, skipping windows before the first page
   d = {}
-  window_id = 0
-  # skip content leading up to first page
-  for page_index, page in enumerate(pages[1:]):
-    # handle case of page id specified in an attribute
-    if xml_page_attr:
-      tag = page.split('>')[0]
-      page_id = tag.split('{}='.format(xml_page_attr))[1].split(' ')[0]
-      page_id = page_id.replace('"', '').replace("'", '')
-      page_id = page_id.rstrip('/>')
-    # hande case of page id between tags
-    elif '</' + xml_page_tag in page:
-      page_id = page.split('</' + xml_page_tag)[0]
-      if '>' in page_id: page_id = page_id.split('>')[1]
-    # handle case of sequential pages without identification (self-closing tags)
-    else:
-      page_id = page_index
-    # clean the page id
-    page_id = str(page_id).strip()
-    # remove the lead tag
-    page = '>'.join(page.split('>')[1:])
-    soup = BeautifulSoup(page, 'html.parser')
-    text = soup.get_text() if soup else ''
-    words = text.split()
-    for word_index, word in enumerate(words):
-      if word_index and (word_index % kwargs['slide_length'] == 0):
-        window_id += 1
-      d[window_id] = page_id
+  page_idx = -1
+  for window_id, word_idx in enumerate(range(0, len(words) - kwargs['window_length'] + 1, kwargs['slide_length'])):
+    while page_idx + 1 < len(page_starts) and page_starts[page_idx + 1][0] <= word_idx:
+      page_idx += 1
+    if page_idx >= 0:
+      d[window_id] = page_starts[page_idx][1]
   return d
 
 
@@ -1246,31 +2507,145 @@ def get_cacheable(*args):
   return {k: kwargs[k] for k in kwargs if isinstance(kwargs[k], Hashable)}
 
 
-def get_word_counts(**kwargs):
-  '''Return a bounter.bounter instance if user requested string likelihoods, else None'''
-  if not kwargs.get('compute_probabilities'): return None
+def write_word_counts(**kwargs):
+  '''Count the words in all infiles in parallel and save the counts where workers can memory-map them'''
+  if not kwargs.get('compute_probabilities'): return
   print(' * computing word counts')
-  counts = bounter(size_mb=int(kwargs.get('bounter_size')))
-  for i in kwargs['infiles']:
-    words = get_words(i, **get_cacheable(kwargs))
-    counts.update(words)
+  if os.path.isdir(word_counts_dir):
+    shutil.rmtree(word_counts_dir)
+  make_dir(word_counts_dir)
+  approximate = kwargs['word_counts'] == 'approximate'
+  if approximate:
+    sketch = np.zeros((sketch_depth, max(1, int(kwargs['bounter_size']) * 2**20 // (sketch_depth * 4))), dtype=np.uint32)
+  counts = [np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)]
+  pending = []
+  f = functools.partial(get_file_word_counts, **kwargs)
+  with get_pool() as pool:
+    for file_hashes, file_counts in imap_bounded(pool, f, kwargs['infiles']):
+      if approximate:
+        for row, columns in enumerate(get_sketch_columns(file_hashes, sketch.shape[1])):
+          np.add.at(sketch[row], columns, file_counts.astype(np.uint32))
+      else:
+        # merge the per-file counts in batches so they never hold more than about word_count_merge_size words
+        pending.append([file_hashes, file_counts])
+        if sum(len(i[0]) for i in pending) >= word_count_merge_size:
+          counts = merge_word_counts([counts] + pending)
+          pending = []
+  if approximate:
+    np.save(os.path.join(word_counts_dir, 'sketch.npy'), sketch)
+  else:
+    counts = merge_word_counts([counts] + pending)
+    np.save(os.path.join(word_counts_dir, 'hashes.npy'), counts[0])
+    np.save(os.path.join(word_counts_dir, 'counts.npy'), counts[1])
   print(' * finished computing word counts')
-  return counts
 
 
-def get_string_sim(a, b, **kwargs):
-  '''Return the similarity between strings a and b'''
-  return SequenceMatcher(None, a, b, autojunk=False).ratio() * 100
+def get_file_word_counts(path, **kwargs):
+  '''Return [word hashes, counts] for the distinct words in a file'''
+  counts = Counter(get_words(path, **get_cacheable(kwargs)))
+  return [get_word_hashes(counts.keys()), np.fromiter(counts.values(), dtype=np.int64, count=len(counts))]
+
 
+def merge_word_counts(counts):
+  '''Given a list of [word hashes, counts] return [sorted distinct word hashes, summed counts]'''
+  hashes, idx = np.unique(np.concatenate([i[0] for i in counts]), return_inverse=True)
+  summed = np.zeros(len(hashes), dtype=np.int64)
+  np.add.at(summed, idx, np.concatenate([i[1] for i in counts]))
+  return [hashes, summed]
 
-def get_string_prob(a, b, counts):
+
+def get_word_hashes(words):
+  '''Return a uint64 array with the 64 bit blake2b hash of each word'''
+  digests = b''.join(hashlib.blake2b(w.encode('utf8'), digest_size=8).digest() for w in words)
+  return np.frombuffer(digests, dtype='<u8').astype(np.uint64)
+
+
+def get_sketch_columns(hashes, width):
+  '''Return the column of each word hash in each row of a count-min sketch'''
+  # derive each row's hash from the two halves of the word hash
+  low = hashes & np.uint64(2**32 - 1)
+  high = hashes >> np.uint64(32)
+  return [((low + np.uint64(row) * high) % np.uint64(width)).astype(np.int64) for row in range(sketch_depth)]
+
+
+def get_word_counts(words, **kwargs):
+  '''Return [the corpus count of each word, the total count of all words] using the counts saved by write_word_counts'''
+  arrays, total = load_word_counts(kwargs['word_counts'], os.stat(word_counts_dir).st_mtime_ns)
+  hashes = get_word_hashes(words)
+  if kwargs['word_counts'] == 'approximate':
+    sketch, = arrays
+    # each row overcounts words that share a column, so the least count is the best estimate
+    counts = np.min([sketch[row][columns] for row, columns in enumerate(get_sketch_columns(hashes, sketch.shape[1]))], axis=0)
+  else:
+    vocab, vocab_counts = arrays
+    idx = np.minimum(np.searchsorted(vocab, hashes), max(0, len(vocab) - 1))
+    counts = np.where(vocab[idx] == hashes, vocab_counts[idx], 0) if len(vocab) else np.zeros(len(hashes))
+  return [counts, total]
+
+
+@functools.lru_cache(maxsize=4)
+def load_word_counts(word_counts, mtime):
+  '''Memory-map the arrays saved by write_word_counts and return [arrays, total count of all words]'''
+  if word_counts == 'approximate':
+    sketch = np.load(os.path.join(word_counts_dir, 'sketch.npy'), mmap_mode='r')
+    return [[sketch], int(sketch[0].sum(dtype=np.int64))]
+  hashes = np.load(os.path.join(word_counts_dir, 'hashes.npy'), mmap_mode='r')
+  counts = np.load(os.path.join(word_counts_dir, 'counts.npy'), mmap_mode='r')
+  return [[hashes, counts], int(counts.sum())]
+
+
+def get_string_sim(a, b, **kwargs):
+  '''Return the similarity between strings a and b, or 0 if a cheap upper bound shows it is below min_sim'''
+  min_sim = kwargs.get('min_sim', 0)
+  # windows copied verbatim need no alignment
+  if a == b: return 100.0
+  if kwargs.get('sim_engine') == 'levenshtein':
+    # the lcs ratio can't exceed twice the shorter length over the summed length
+    total = len(a) + len(b)
+    if total and 200 * min(len(a), len(b)) / total < min_sim - sim_bound_tolerance: return 0
+    return ratio(a, b) * 100
+  matcher = SequenceMatcher(None, a, b, autojunk=False)
+  # real_quick_ratio bounds the ratio by string lengths, quick_ratio by shared character counts
+  for bound in [matcher.real_quick_ratio, matcher.quick_ratio]:
+    if bound() * 100 < min_sim: return 0
+  return matcher.ratio() * 100
+
+
+def get_string_prob(a, b, **kwargs):
   '''Return the maximum probability of s1 and s2 as a float'''
-  if not counts: return -1
-  probs_a = sum([counts[w] / counts.total() for w in a.split()])
-  probs_b = sum([counts[w] / counts.total() for w in b.split()])
+  if not kwargs.get('compute_probabilities'): return -1
+  counts_a, total = get_word_counts(a.split(), **kwargs)
+  counts_b, total = get_word_counts(b.split(), **kwargs)
+  if not total: return -1
+  probs_a = float(counts_a.sum()) / total
+  probs_b = float(counts_b.sum()) / total
   return round(max([probs_a, probs_b]), 3) * 1000
 
 
+def append_to_file(path, s):
+  '''Append a string to a file in a single write so concurrent writers never interleave their lines'''
+  fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+  try:
+    os.write(fd, s.encode('utf8'))
+  finally:
+    os.close(fd)
+
+
+def truncate_partial_line(path):
+  '''Remove the partial line an interrupted write may have left at the end of a file'''
+  with open(path, 'rb+') as f:
+    end = f.seek(0, os.SEEK_END)
+    while end > 0:
+      start = max(0, end - 2**16)
+      f.seek(start)
+      idx = f.read(end - start).rfind(row_delimiter.encode('utf8'))
+      if idx >= 0:
+        f.truncate(start + idx + 1)
+        return
+      end = start
+    f.truncate(0)
+
+
 def make_dir(path):
   '''Make a directory if it doesn't exist'''
   if not os.path.exists(path):
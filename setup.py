@@ -16,11 +16,6 @@ setup(
   author_email='douglas.duhaime@gmail.com',
   license='MIT',
   install_requires=[
-    'beautifulsoup4==4.5.1',
-    'bounter==1.1.1',
-    'datasketch==0.2.6',
-    'networkx>=2.4',
-    'nltk==3.4.5',
     'numpy==1.20.1',
     'requests==2.24.0',
     'unidecode==1.2.0',